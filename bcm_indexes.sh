@@ -14,7 +14,7 @@ bcm_indexes() {
 
     if [ -d "$input_file" ]; then
         echo "Appending BCM indexes"
-        python src/append_climate_indexes.py "$input_file" "$config" "$output_directory"
+        cached "$output_directory" python src/append_climate_indexes.py "$input_file" "$config" "$output_directory"
 
         if [ $? -eq 0 ]; then
             echo "BCM indexes computation completed successfully."
@@ -34,6 +34,15 @@ delete_directory() {
     fi
 }
 
+# Function to run a stage through the stage cache, which links in the
+# output of an earlier run with identical code, configs and inputs
+# Usage: cached <output> <command...>
+cached() {
+    local output="$1"
+    shift
+    python src/stage_cache.py run -d "${cachedir}" -b "${config_cache_budget}" -o "${output}" -- "$@"
+}
+
 # Print loaded configuration
 print_config() {
     printf "Loaded configuration from %s:\n" "$CONFIGFILE"
@@ -62,3 +71,4 @@ bcm_variables=(aet cwd pck pet ppt)
 topodir="${config_root_dir}/${config_topo_subdir}"
 projdir="${config_root_dir}/${config_projections_subdir}"
 resultsdir="${config_root_dir}/${config_results_subdir}"
+cachedir="${config_root_dir}/${config_cache_subdir}"
@@ -3,12 +3,127 @@ import os
 import json
 import click
 import warnings
+import numpy as np
 import xarray as xr
+import rioxarray
+import dask.array as da
 from pathlib import Path
-from dask.diagnostics import ProgressBar
+
+from execution import start_execution, run
+from profiling import profile_option
+from chunking import open_series, resolve_chunks
+
+
+REDUCTIONS = (
+    'sum', 'mean', 'min', 'max', 'std', 'var',
+    'median', 'quantile', 'count', 'count_above',
+)
+SCANS = ('cumsum', 'cumprod')
+
+
+def reduce_block(block, axis, statistics):
+    """
+    Compute all reductions along the time axis of a single block
+    """
+    results = []
+    for statistic, kwargs in statistics:
+        skipna = kwargs.get('skipna', True)
+        if statistic in ('median', 'quantile'):
+            q = 0.5 if statistic == 'median' else kwargs['q']
+            func = np.nanquantile if skipna else np.quantile
+            value = func(block, q, axis=axis)
+        elif statistic == 'count':
+            value = np.sum(np.logical_not(np.isnan(block)), axis=axis)
+        elif statistic == 'count_above':
+            value = np.sum(block > kwargs['threshold'], axis=axis)
+        else:
+            func = getattr(np, f'nan{statistic}' if skipna else statistic)
+            extra = {'ddof': kwargs['ddof']} if 'ddof' in kwargs else {}
+            value = func(block, axis=axis, **extra)
+        results.append(np.asarray(value, dtype=np.float64))
+
+    return np.stack(results, axis=0)
+
+
+def scan_block(block, axis, statistics):
+    """
+    Compute all cumulative statistics along the time axis of a single block
+    """
+    results = []
+    for statistic, kwargs in statistics:
+        skipna = kwargs.get('skipna', True)
+        func = getattr(np, f'nan{statistic}' if skipna else statistic)
+        results.append(func(block, axis=axis).astype(np.float64))
+
+    return np.stack(results, axis=0)
+
+
+def fused_statistics(array, statistics, dim='year'):
+    """
+    Evaluate every configured statistic of one variable with one task per
+    input chunk (per kind of output), keeping the spatial chunking of the
+    input so outputs can be written without a rechunk
+    """
+    for s in statistics:
+        if s['statistic'] not in REDUCTIONS + SCANS:
+            raise ValueError(f'Unsupported statistic "{s["statistic"]}"')
+        if np.ndim(s.get('kwargs', {}).get('q', 0)) > 0:
+            raise ValueError('Only scalar quantiles are supported')
+
+    axis = array.get_axis_num(dim)
+    data = array.data
+    if not isinstance(data, da.Array):
+        data = da.from_array(data)
+
+    # The kernels need the full time series of each block; spatial chunks
+    # are left untouched
+    if len(data.chunks[axis]) > 1:
+        data = data.rechunk({axis: -1})
+
+    reduced_dims = [d for d in array.dims if d != dim]
+    reduced_coords = {
+        k: v for k, v in array.coords.items() if dim not in v.dims
+    }
+
+    outputs = []
+    for kinds, func in ((REDUCTIONS, reduce_block), (SCANS, scan_block)):
+        group = [s for s in statistics if s['statistic'] in kinds]
+        if len(group) == 0:
+            continue
+
+        args = [(s['statistic'], s.get('kwargs', {})) for s in group]
+        if func is reduce_block:
+            chunks = ((len(group),),) + tuple(
+                c for i, c in enumerate(data.chunks) if i != axis
+            )
+            combined = da.map_blocks(
+                func, data, axis=axis, statistics=args,
+                drop_axis=axis, new_axis=0, chunks=chunks,
+                dtype=np.float64,
+            )
+            dims, coords = reduced_dims, reduced_coords
+        else:
+            combined = da.map_blocks(
+                func, data, axis=axis, statistics=args,
+                new_axis=0, chunks=((len(group),),) + data.chunks,
+                dtype=np.float64,
+            )
+            dims, coords = array.dims, array.coords
+
+        outputs += [
+            xr.DataArray(
+                combined[i], dims=dims, coords=coords,
+                name=s['name'], attrs=s.get('attrs', {}),
+            )
+            for i, s in enumerate(group)
+        ]
+
+    order = [s['name'] for s in statistics]
+    return sorted(outputs, key=lambda o: order.index(o.name))
 
 
 @click.command()
+@profile_option
 @click.argument('projectionfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -29,33 +144,32 @@ def main(projectionfile, configfile, outputfile):
         config = json.load(f)
 
     statistics = config['statistics']
-    chunks = config['chunks']
-
-    ds = xr.open_zarr(projectionfile)
-
-    stats = [
-        getattr(
-            ds[s['variable']], s['statistic']
-        )(
-            dim='year', **s.get('kwargs', {})
-        ).rename(
-            s['name']
-        )
-        for s in statistics
-    ]
-    for s, sinfo in zip(stats, statistics):
-        s.attrs.update(**sinfo.get('attrs', {}))
+    chunks = config.get('chunks', None)
+
+    start_execution(config)
+
+    ds = open_series(projectionfile)
+
+    # Group statistics by variable so each variable is scanned once
+    variables = list(dict.fromkeys(s['variable'] for s in statistics))
+    stats = []
+    for var in variables:
+        vstats = [s for s in statistics if s['variable'] == var]
+        stats += fused_statistics(ds[var], vstats, dim='year')
 
     dataset = xr.merge(stats, join='exact', combine_attrs='drop')
 
     dataset.rio.write_crs(ds.rio.crs, inplace=True)
 
-    write_job = dataset.chunk(chunks).to_zarr(
+    # Without explicit chunks, the output keeps the chunks of the kernels
+    if chunks is not None:
+        dataset = dataset.chunk(resolve_chunks(dataset, chunks))
+
+    write_job = dataset.to_zarr(
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
 
 
 if __name__ == '__main__':
@@ -4,8 +4,13 @@ import click
 from pathlib import Path
 import numpy as np
 import xarray as xr
+import dask.array as da
 from tqdm import tqdm
-from dask.diagnostics import ProgressBar
+
+from execution import start_execution, run
+from profiling import profile_option
+from chunking import resolve_chunks, write_series_copy
+from precision import apply_precision, checked, save_report
 
 
 WY_DETLA = np.timedelta64(3, 'M').astype('timedelta64[M]')
@@ -22,7 +27,124 @@ def aggregate(ds, **kwargs):
     ], combine_attrs='drop_conflicts')
 
 
+def water_year_layout(times):
+    """
+    Locate the complete water years in a monthly time axis. Returns the
+    slice of complete years, their labels, and the partial years at each
+    edge as (year, slice) pairs.
+    """
+    months = to_water_year(times).astype('datetime64[M]').astype(int)
+    if np.any(np.diff(months) != 1):
+        raise ValueError('Monthly time axis is not contiguous')
+
+    # Month 0 of each water year is October
+    month_of_year = months % 12
+    years = months // 12 + 1970
+
+    start = int(np.argmax(month_of_year == 0))
+    if month_of_year[start] != 0:
+        start = len(months)
+    n_full = (len(months) - start) // 12
+    stop = start + 12 * n_full
+
+    partial = []
+    if start > 0:
+        partial.append((years[0], slice(0, start)))
+    if stop < len(months):
+        partial.append((years[-1], slice(stop, len(months))))
+
+    return slice(start, stop), years[start:stop:12], partial
+
+
+def aggregate_block(block, axis, afunc):
+    shape = block.shape
+    new_shape = shape[:axis] + (shape[axis] // 12, 12) + shape[axis + 1:]
+    return getattr(np, afunc)(block.reshape(new_shape), axis=(axis + 1))
+
+
+def aggregate_water_years(var, afunc, full, years, years_per_chunk=1):
+    """
+    Reduce the complete water years of a monthly variable by reshaping the
+    time axis into (water_year, 12) blocks, one dask task per block
+    """
+    axis = var.get_axis_num('time')
+    data = var.data
+    if not isinstance(data, da.Array):
+        data = da.from_array(data)
+
+    data = data[(slice(None),) * axis + (full,)]
+    data = data.rechunk({axis: 12 * years_per_chunk})
+
+    chunks = list(data.chunks)
+    chunks[axis] = tuple(c // 12 for c in chunks[axis])
+
+    aggregated = da.map_blocks(
+        aggregate_block, data, axis=axis, afunc=afunc,
+        chunks=tuple(chunks), dtype=var.dtype,
+    )
+
+    dims = tuple('year' if d == 'time' else d for d in var.dims)
+    coords = {
+        k: v for k, v in var.coords.items() if 'time' not in v.dims
+    }
+    coords['year'] = years
+
+    return xr.DataArray(
+        aggregated, dims=dims, coords=coords,
+        name=var.name, attrs=var.attrs,
+    )
+
+
+def aggregate_dataset(ds, config):
+    """
+    Aggregate a monthly dataset to water years
+    """
+    chunks = config['chunks']
+    out_chunks = config['output_chunks']
+    aggregation_funcs = config['aggregation']
+    partial_years = config.get('partial_water_years', 'keep')
+
+    if partial_years not in ('keep', 'drop'):
+        raise ValueError(f'Unknown partial water year mode "{partial_years}"')
+
+    ds = ds.chunk(chunks)
+
+    print('Locating water years...')
+    full, years, partial = water_year_layout(ds.time.values)
+    for year, months in partial:
+        n_months = months.stop - months.start
+        print(
+            f'Partial water year {year}: {n_months} of 12 months '
+            f'({partial_years})'
+        )
+
+    print('Apply aggregation functions...')
+    years_per_chunk = max(1, chunks.get('time', 12) // 12)
+    aggregated = xr.merge([
+        aggregate_water_years(
+            ds[var], afunc, full, years, years_per_chunk
+        )
+        for var, afunc in aggregation_funcs.items()
+    ], combine_attrs='drop_conflicts')
+
+    if partial_years == 'keep' and len(partial) > 0:
+        edges = [
+            aggregate(
+                ds.isel(time=months), **aggregation_funcs
+            ).expand_dims(year=[year])
+            for year, months in partial
+        ]
+        aggregated = xr.concat(
+            [aggregated] + edges, dim='year',
+            combine_attrs='drop_conflicts'
+        ).sortby('year')
+
+    print('Chunking data...')
+    return aggregated.chunk(resolve_chunks(aggregated, out_chunks))
+
+
 @click.command()
+@profile_option
 @click.argument('inputfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -37,23 +159,12 @@ def main(inputfile, configfile, outputfile):
     with open(configfile, 'r') as f:
         config = json.load(f)
 
-    chunks = config['chunks']
-    out_chunks = config['output_chunks']
-    aggregation_funcs = config['aggregation']
+    start_execution(config)
 
     with xr.open_zarr(inputfile) as ds:
-        ds = ds.chunk(chunks)
-        print('Convert years to water years...')
-        ds = ds.assign_coords(time=to_water_year(ds.time.values))
-
-        print('Apply grouping...')
-        grouped = ds.groupby('time.year')
-
-        print('Apply aggregation functions...')
-        aggregated = grouped.map(aggregate, **aggregation_funcs)
-
-        print('Chunking data...')
-        aggregated = aggregated.chunk(out_chunks)
+        aggregated = aggregate_dataset(ds, config)
+        precision = config.get('precision', None)
+        aggregated, deviations = apply_precision(aggregated, precision)
 
         print('Creating write job...')
         write_job = aggregated.to_zarr(
@@ -61,8 +172,9 @@ def main(inputfile, configfile, outputfile):
         )
 
         print('Writing output...')
-        with ProgressBar():
-            write_job.compute()
+        report = run(checked(write_job, deviations))
+        save_report(outputfile, report, precision)
+        write_series_copy(outputfile, config['output_chunks'])
         print('Done')
 
 
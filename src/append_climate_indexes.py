@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 import json
+import dask
 import click
 from pathlib import Path
 import numpy as np
 import xarray as xr
 from tqdm import tqdm
 from scipy.stats import norm, gamma
+from multiprocessing import get_context
 from concurrent.futures import ProcessPoolExecutor
 
+from grid_registry import align_to_grid, grid_from_dataset, load_grid
+from execution import start_execution, run
+from profiling import profile_option, profiled
+from chunking import open_series, resolve_chunks, write_series_copy
+from precision import apply_precision, checked, save_report
+
 def _compute_si(focus, ref, dist=gamma, prob_zero=False, fit_kwargs=None):
     nan_values = np.isnan(ref)
     if np.all(nan_values):
@@ -138,6 +146,7 @@ def process_index(idx, ds, span, focal_period, reference_period, time_dim, compu
     })
     return name, sub
 
+@profiled('make_indices')
 def make_indices(ds, span, focal_period, reference_period, indices, time_dim='year'):
     computed_indices = {}
     ret_indices = []
@@ -150,9 +159,17 @@ def make_indices(ds, span, focal_period, reference_period, indices, time_dim='ye
                 computed_indices[name] = result
                 ret_indices.append(result)
 
-    with ProcessPoolExecutor() as executor:
+    # The distribution fits run in worker processes on inputs computed here,
+    # on the active scheduler: the workers are spawned rather than forked
+    # and never compute Dask graphs themselves, which would deadlock on a
+    # distributed client inherited from this process
+    loaded_indices = dict(zip(
+        computed_indices, dask.compute(*computed_indices.values())
+    ))
+
+    with ProcessPoolExecutor(mp_context=get_context('spawn')) as executor:
         futures = [
-            executor.submit(process_index, idx, ds, span, focal_period, reference_period, time_dim, computed_indices)
+            executor.submit(process_index, idx, None, span, focal_period, reference_period, time_dim, loaded_indices)
             for idx in indices if idx['name'] in ["SPI", "SPEI"]
         ]
         for future in tqdm(futures, desc=f'Processing Span {span} Indices'):
@@ -161,15 +178,11 @@ def make_indices(ds, span, focal_period, reference_period, indices, time_dim='ye
                 ret_indices.append(result)
     return ret_indices
 
-@click.command()
-@click.argument('inputfile', type=click.Path(path_type=Path, exists=True))
-@click.argument('configfile', type=click.Path(path_type=Path, exists=True))
-@click.argument('outputfile', type=click.Path(path_type=Path, exists=False))
-@click.option('-r', '--reference', type=click.Path(path_type=Path, exists=False), default=None)
-def main(inputfile, configfile, outputfile, reference):
-    with open(configfile, 'r') as f:
-        config = json.load(f)
-
+def climate_indexes(ds, config, dsref=None, grid=None):
+    """
+    Compute the configured climate indexes of a dataset, optionally using a
+    reference dataset for the reference period
+    """
     reference_period = config['reference_period']
     focal_period = config['focal_period']
     spans = config['spans']
@@ -178,7 +191,6 @@ def main(inputfile, configfile, outputfile, reference):
     chunks = config['chunks']
     out_chunks = config['output_chunks']
 
-    ds = xr.open_zarr(inputfile)
     ds = ds.chunk(chunks)
 
     for dim, size in ds.sizes.items():
@@ -188,18 +200,12 @@ def main(inputfile, configfile, outputfile, reference):
     print(ds.sizes)
     print(ds)
 
-    if reference is not None:
-        dsref = xr.open_zarr(reference)
+    if dsref is not None:
         dsref = dsref.chunk(chunks)
 
-        ds = ds.assign_coords(
-            easting=np.round(ds.easting.values, 4),
-            northing=np.round(ds.northing.values, 4),
-        )
-        dsref = dsref.assign_coords(
-            easting=np.round(dsref.easting.values, 4),
-            northing=np.round(dsref.northing.values, 4),
-        )
+        if grid is None:
+            grid = grid_from_dataset(dsref)
+        dsref, ds = align_to_grid([dsref, ds], grid)
 
         ds = xr.concat(
             [
@@ -209,7 +215,7 @@ def main(inputfile, configfile, outputfile, reference):
             dim=time_dim,
             data_vars='all',
             coords='all',
-            join='inner'
+            join='exact'
         )
         ds.rio.write_crs(dsref.rio.crs, inplace=True)
 
@@ -225,12 +231,39 @@ def main(inputfile, configfile, outputfile, reference):
     indices_ds = xr.merge(
         all_indices, combine_attrs='drop_conflicts'
     )
-    indices_ds = indices_ds.chunk(out_chunks)
+    indices_ds = indices_ds.chunk(resolve_chunks(indices_ds, out_chunks))
     print(indices_ds)
 
-    indices_ds.to_zarr(
-        outputfile, mode='w', consolidated=True
+    return indices_ds
+
+@click.command()
+@profile_option
+@click.argument('inputfile', type=click.Path(path_type=Path, exists=True))
+@click.argument('configfile', type=click.Path(path_type=Path, exists=True))
+@click.argument('outputfile', type=click.Path(path_type=Path, exists=False))
+@click.option('-r', '--reference', type=click.Path(path_type=Path, exists=False), default=None)
+@click.option('-g', '--grid', 'gridfile', type=click.Path(path_type=Path, exists=True), default=None,
+    help='Registered grid (defaults to the grid of the reference dataset)')
+def main(inputfile, configfile, outputfile, reference, gridfile):
+    with open(configfile, 'r') as f:
+        config = json.load(f)
+
+    start_execution(config)
+
+    ds = open_series(inputfile)
+    dsref = None if reference is None else open_series(reference)
+    grid = None if gridfile is None else load_grid(gridfile)
+
+    indices_ds = climate_indexes(ds, config, dsref, grid)
+    precision = config.get('precision', None)
+    indices_ds, deviations = apply_precision(indices_ds, precision)
+
+    write_job = indices_ds.to_zarr(
+        outputfile, mode='w', compute=False, consolidated=True
     )
+    report = run(checked(write_job, deviations), 'write', [outputfile])
+    save_report(outputfile, report, precision)
+    write_series_copy(outputfile, config['output_chunks'])
     print('Done')
 
 if __name__ == '__main__':
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
+import os
 import json
 import click
 import numpy as np
 import xarray as xr
 import rioxarray
 from pathlib import Path
-from dask.diagnostics import ProgressBar
+
+from execution import start_execution, run
+from profiling import profile_option
+
+
+# Attribute of an overlay store holding the path of its base dataset,
+# relative to the overlay itself
+OVERLAY_BASE_ATTR = 'overlay_base'
 
 
 def make_folds(ds, grid_size, shuffle=False):
@@ -14,14 +22,13 @@ def make_folds(ds, grid_size, shuffle=False):
     cc = np.arange(cols) // grid_size
     rr = (cc.max() + 1) * (np.arange(rows) // grid_size)
 
-    folds = np.zeros((cols, rows), dtype=int) + cc[..., np.newaxis] + rr
+    folds = cc[:, np.newaxis] + rr[np.newaxis, :]
     idx = np.arange(cols * rows, dtype=int).reshape((rows, cols)).T
 
     if shuffle:
-        np.random.seed(0)
-        folds_tmp = folds.ravel()
-        np.random.shuffle(folds_tmp)
-        folds = folds_tmp.reshape((cols, rows))
+        # Same permutation as seeding the global generator with 0
+        folds = np.random.RandomState(0).permutation(folds.ravel())
+        folds = folds.reshape((cols, rows))
 
     dataset = xr.Dataset(
         data_vars={
@@ -49,7 +56,86 @@ def make_folds(ds, grid_size, shuffle=False):
     return dataset
 
 
+def make_fold_index(folds, ids):
+    """
+    Build a compressed (CSR) fold index: the sorted ids belonging to the
+    i-th fold are ids[fold_ptr[i]:fold_ptr[i + 1]]
+    """
+    folds = np.asarray(folds).ravel()
+    ids = np.asarray(ids).ravel()
+
+    order = np.lexsort((ids, folds))
+    fold_values, counts = np.unique(folds, return_counts=True)
+    fold_ptr = np.concatenate([[0], np.cumsum(counts)])
+
+    return xr.Dataset(
+        data_vars={
+            'fold_ptr': (
+                ['fold_bound'], fold_ptr,
+                { 'long_name': 'fold offsets into fold_ids' }
+            ),
+            'fold_ids': (
+                ['cell'], ids[order],
+                { 'long_name': 'cell identifiers sorted by fold' }
+            ),
+        },
+        coords={
+            'fold': fold_values,
+        }
+    )
+
+
+def fold_members(fold_index, fold):
+    """
+    Return the sorted ids belonging to `fold`
+    """
+    i = int(np.searchsorted(fold_index['fold'].values, fold))
+    if i >= fold_index.sizes['fold'] or fold_index['fold'].values[i] != fold:
+        return np.array([], dtype=fold_index['fold_ids'].dtype)
+    ptr = fold_index['fold_ptr'].values
+    return fold_index['fold_ids'].values[ptr[i]:ptr[i + 1]]
+
+
+def open_folds(foldfile, **kwargs):
+    """
+    Open a fold dataset. If it is an overlay holding only `fold` and `id`,
+    it is lazily joined with the base dataset it was created from.
+    """
+    ds = xr.open_zarr(foldfile, **kwargs)
+    base = ds.attrs.get(OVERLAY_BASE_ATTR, None)
+    if base is None:
+        return ds
+
+    basefile = os.path.normpath(os.path.join(foldfile, base))
+    base_ds = xr.open_zarr(basefile, **kwargs)
+    return xr.merge(
+        [base_ds, ds], join='exact', combine_attrs='override'
+    )
+
+
+def add_folds(ds, config, inputfile=None, outputfile=None):
+    """
+    Return the dataset with `fold` and `id` variables. If the config asks
+    for an `overlay` and the paths of the input and output stores are
+    given, only the new variables are returned, referring back to the input.
+    """
+    folds = make_folds(ds, config['grid_size'], config['shuffle'])
+    chunks = config['chunks']
+
+    if config.get('overlay', False) and inputfile is not None:
+        dataset = folds.chunk({
+            k: v for k, v in chunks.items() if k in folds.dims
+        })
+        dataset.attrs[OVERLAY_BASE_ATTR] = os.path.relpath(
+            os.path.abspath(inputfile), os.path.abspath(outputfile)
+        )
+        return dataset
+
+    return xr.merge([ds, folds], join='exact').chunk(chunks)
+
+
 @click.command()
+@profile_option
 @click.argument('inputfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -64,24 +150,18 @@ def main(inputfile, configfile, outputfile):
     # Load config
     with open(configfile, 'r') as f:
         config = json.load(f)
-    grid_size = config['grid_size']
-    chunks = config['chunks']
-    shuffle = config['shuffle']
 
-    ds = xr.open_zarr(inputfile)
-
-    folds = make_folds(ds, grid_size, shuffle)
+    start_execution(config)
 
-    new_dataset = xr.merge([ds, folds], join='exact')
+    ds = xr.open_zarr(inputfile)
 
-    new_dataset = new_dataset.chunk(chunks)
+    new_dataset = add_folds(ds, config, inputfile, outputfile)
 
     write_job = new_dataset.to_zarr(
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
 
 
 if __name__ == '__main__':
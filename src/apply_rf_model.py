@@ -7,10 +7,14 @@ import numpy as np
 import xarray as xr
 import rioxarray
 from pathlib import Path
-from skops.io import load
-from dask.diagnostics import ProgressBar
 
 from train_rf_model_ray import filter_inf
+from models import model_features
+from model_registry import load_model_info
+from execution import start_execution, run
+from profiling import profile_option, profiled
+from chunking import resolve_chunks, write_series_copy
+from precision import apply_precision, checked, save_report
 
 
 def features_to_info(feature_names):
@@ -39,10 +43,10 @@ def get_feature(clim, year, feature_name):
 
 
 @ray.remote
+@profiled('apply_model')
 def apply_model(climatefile, modelfile, year):
 
-    with open(modelfile, 'rb') as f:
-        model_info = load(f)
+    model_info = load_model_info(modelfile)
 
     features = model_info['features']
     model = model_info['model']
@@ -56,7 +60,7 @@ def apply_model(climatefile, modelfile, year):
         X = cube.reshape((-1, len(features)))
         y = np.full((X.shape[0],), np.nan)
         good = np.logical_not(np.any(np.isnan(X), axis=1))
-        X_good = filter_inf(X[good])
+        X_good = model_features(filter_inf(X[good]), model_info)
 
         y_good = model.predict(X_good)
 
@@ -67,6 +71,7 @@ def apply_model(climatefile, modelfile, year):
 
 
 @click.command()
+@profile_option
 @click.argument('climatefile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -91,6 +96,8 @@ def main(climatefile, modelfile, configfile, outputfile):
     year_range = config['year_range']
     years = list(range(year_range['start'], year_range['end']))
 
+    start_execution(config)
+
     clim = xr.open_zarr(climatefile)
 
     ray.init(num_cpus=5)
@@ -119,13 +126,19 @@ def main(climatefile, modelfile, configfile, outputfile):
 
     dataset.rio.write_crs(clim.rio.crs, inplace=True)
 
-    write_job = dataset.chunk(chunks).to_zarr(
+    precision = config.get('precision', None)
+    dataset, deviations = apply_precision(
+        dataset.chunk(resolve_chunks(dataset, chunks)), precision
+    )
+
+    write_job = dataset.to_zarr(
         outputfile, mode='w', compute=False, consolidated=True
     )
 
     print(f'Writing data...')
-    with ProgressBar():
-        write_job.persist()
+    report = run(checked(write_job, deviations))
+    save_report(outputfile, report, precision)
+    write_series_copy(outputfile, chunks)
     print('Done')
 
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+EcoPro Tree Mortality
+Chunk Planning
+
+A chunk spec in a config is either explicit chunk sizes by dimension, or a
+plan: `"auto"`, or a dict with the dimensions downstream readers access
+whole (`access`), the target chunk size in MB (`target_mb`), and whether to
+write a time-contiguous copy of the output for pixel-series readers
+(`series_copy`, along `time_dim`).
+"""
+import click
+import numpy as np
+import xarray as xr
+from pathlib import Path
+
+from execution import run
+from profiling import profile_option
+
+
+DEFAULT_TARGET_MB = 128
+
+PLAN_KEYS = ('access', 'target_mb', 'series_copy', 'time_dim')
+
+SERIES_SUFFIX = '_series'
+
+
+def is_plan(spec):
+    if isinstance(spec, str):
+        return spec == 'auto'
+    return isinstance(spec, dict) and any(k in spec for k in PLAN_KEYS)
+
+
+def plan_options(spec):
+    return {} if isinstance(spec, str) else spec
+
+
+def balanced_chunks(sizes, budget):
+    """
+    Split a budget of elements evenly across dimensions, passing what
+    dimensions shorter than their share leave unused on to the others
+    """
+    chunks = {}
+    remaining = dict(sizes)
+    while remaining:
+        edge = budget ** (1.0 / len(remaining))
+        short = { d: s for d, s in remaining.items() if s <= edge }
+        if not short:
+            chunks.update({ d: max(1, int(edge)) for d in remaining })
+            break
+        for d, s in short.items():
+            chunks[d] = s
+            budget = max(1, budget // s)
+            del remaining[d]
+    return chunks
+
+
+def plan_chunks(sizes, itemsize, target_bytes, access=()):
+    """
+    Chunk sizes of about `target_bytes` that keep the `access` dimensions
+    whole (split evenly if they alone exceed the target) and are balanced
+    across the other dimensions
+    """
+    budget = max(1, target_bytes // itemsize)
+    whole = { d: sizes[d] for d in access if d in sizes }
+    other = { d: s for d, s in sizes.items() if d not in whole }
+
+    n_whole = int(np.prod(list(whole.values()), dtype=np.int64))
+    if n_whole > budget:
+        chunks = balanced_chunks(whole, budget)
+        budget = 1
+    else:
+        chunks = dict(whole)
+        budget = budget // n_whole
+
+    chunks.update(balanced_chunks(other, budget))
+    return { d: min(chunks[d], sizes[d]) for d in sizes }
+
+
+def dataset_itemsize(ds):
+    return max(
+        (v.dtype.itemsize for v in ds.data_vars.values()), default=8
+    )
+
+
+def resolve_chunks(ds, spec):
+    """
+    Chunk sizes for writing a dataset: explicit specs are returned as they
+    are, plans are resolved against the dataset's shape and dtypes
+    """
+    if not is_plan(spec):
+        return spec
+    options = plan_options(spec)
+    target_mb = options.get('target_mb', DEFAULT_TARGET_MB)
+    return plan_chunks(
+        dict(ds.sizes), dataset_itemsize(ds), int(target_mb * 2**20),
+        options.get('access', ()),
+    )
+
+
+def series_store(path):
+    path = Path(path)
+    return path.with_name(f'{path.stem}{SERIES_SUFFIX}{path.suffix}')
+
+
+def clear_chunk_encoding(ds):
+    for var in ds.variables.values():
+        var.encoding.pop('chunks', None)
+        var.encoding.pop('preferred_chunks', None)
+    return ds
+
+
+def write_series_copy(outputfile, spec):
+    """
+    If the plan asks for it, write a copy of a written store with chunks
+    that keep the time dimension whole, next to the store
+    """
+    if not is_plan(spec) or not plan_options(spec).get('series_copy', False):
+        return None
+    options = plan_options(spec)
+    time_dim = options.get('time_dim', 'year')
+
+    seriesfile = series_store(outputfile)
+    with xr.open_zarr(outputfile) as ds:
+        series = clear_chunk_encoding(ds.chunk(resolve_chunks(ds, {
+            'access': [time_dim],
+            'target_mb': options.get('target_mb', DEFAULT_TARGET_MB),
+        })))
+        print(f'Writing time-contiguous copy {seriesfile}...')
+        write_job = series.to_zarr(
+            seriesfile, mode='w', compute=False, consolidated=True
+        )
+        run(write_job, 'write_series_copy', [seriesfile])
+    return seriesfile
+
+
+def open_series(path, **kwargs):
+    """
+    Open the time-contiguous copy of a store if it has one that was written
+    after the store
+    """
+    seriesfile = series_store(path)
+    if (
+        seriesfile.exists()
+        and seriesfile.stat().st_mtime >= Path(path).stat().st_mtime
+    ):
+        return xr.open_zarr(seriesfile, **kwargs)
+    return xr.open_zarr(path, **kwargs)
+
+
+@click.command()
+@profile_option
+@click.argument('datasetfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.option('-a', '--access', multiple=True,
+    help='Dimension read whole by downstream readers (repeatable)')
+@click.option('-t', '--target-mb', type=float, default=DEFAULT_TARGET_MB)
+def main(datasetfile, access, target_mb):
+    """
+    Print the planned chunks of a dataset next to its current chunks
+    """
+    ds = xr.open_zarr(datasetfile)
+    chunks = resolve_chunks(ds, {
+        'access': list(access), 'target_mb': target_mb
+    })
+    itemsize = dataset_itemsize(ds)
+    size = int(np.prod(list(chunks.values()), dtype=np.int64)) * itemsize
+    print(f'Current: { {k: v[0] for k, v in ds.chunksizes.items()} }')
+    print(f'Planned: {chunks} ({size / 2**20:.1f} MB per chunk)')
+
+
+if __name__ == '__main__':
+    main()
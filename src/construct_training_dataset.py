@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 import json
 import click
-import numpy as np
 import xarray as xr
 import rioxarray
 from pathlib import Path
 from tqdm import tqdm
-from dask.diagnostics import ProgressBar
 
 from util import load_config
+from append_folds import open_folds
+from grid_registry import align_to_grid, grid_from_dataset, load_grid
+from execution import start_execution, run
+from profiling import profile_option
+from chunking import resolve_chunks
+from precision import apply_precision, checked, save_report
 
 
 def get_climate_features(clim, year, feature_info):
@@ -50,7 +54,7 @@ def to_samples(mort, clim, topo, year, feature_info, target):
     features += get_climate_features(clim, year, feature_info['climate'])
     features += get_topography_features(topo, feature_info['topography'])
 
-    feat_ds = xr.merge(features, join='inner', combine_attrs='drop')
+    feat_ds = xr.merge(features, join='exact', combine_attrs='drop')
     feat_ds = feat_ds.drop_vars(('year', 'spatial_ref',))
     feat_ds = feat_ds.stack(sample=('easting', 'northing'), create_index=False)
     feat_ds = feat_ds.reset_coords(('northing', 'easting'))
@@ -59,37 +63,20 @@ def to_samples(mort, clim, topo, year, feature_info, target):
     return feat_ds
 
 
-@click.command()
-@click.argument('mortalityfile', type=click.Path(path_type=Path, exists=True))
-@click.argument('climatefile', type=click.Path(path_type=Path, exists=True))
-@click.argument('topofile', type=click.Path(path_type=Path, exists=True))
-@click.argument('configfile', type=click.Path(path_type=Path, exists=True))
-@click.argument('outputfile', type=click.Path(path_type=Path, exists=False))
-def main(mortalityfile, climatefile, topofile, configfile, outputfile):
-    config = load_config(configfile)
-
+def training_dataset(mort, clim, topo, config, grid=None):
+    """
+    Combine the mortality, climate, and topography datasets into samples of
+    the configured years with a valid target
+    """
     years = config['years']
     finfo = config['features']
     chunks = config['chunks']
     target = config['target']
 
-    mort = xr.open_zarr(mortalityfile)
-    clim = xr.open_zarr(climatefile)
-    topo = xr.open_zarr(topofile)
-
-    # Fix coordinate mis-match issue due to rounding
-    mort = mort.assign_coords(
-        easting=np.round(mort.easting.values, 4),
-        northing=np.round(mort.northing.values, 4),
-    )
-    clim = clim.assign_coords(
-        easting=np.round(clim.easting.values, 4),
-        northing=np.round(clim.northing.values, 4),
-    )
-    topo = topo.assign_coords(
-        easting=np.round(topo.easting.values, 4),
-        northing=np.round(topo.northing.values, 4),
-    )
+    # Put all inputs on identical grid coordinates
+    if grid is None:
+        grid = grid_from_dataset(clim)
+    mort, clim, topo = align_to_grid([mort, clim, topo], grid)
 
     combined = xr.concat(
         [
@@ -103,13 +90,39 @@ def main(mortalityfile, climatefile, topofile, configfile, outputfile):
     good = combined[target].notnull().compute()
     combined = combined.where(good, drop=True)
 
-    write_job = combined.chunk(chunks).to_zarr(
+    return combined.chunk(resolve_chunks(combined, chunks))
+
+
+@click.command()
+@profile_option
+@click.argument('mortalityfile', type=click.Path(path_type=Path, exists=True))
+@click.argument('climatefile', type=click.Path(path_type=Path, exists=True))
+@click.argument('topofile', type=click.Path(path_type=Path, exists=True))
+@click.argument('configfile', type=click.Path(path_type=Path, exists=True))
+@click.argument('outputfile', type=click.Path(path_type=Path, exists=False))
+@click.option('-g', '--grid', 'gridfile', type=click.Path(path_type=Path, exists=True), default=None,
+    help='Registered grid (defaults to the grid of the climate dataset)')
+def main(mortalityfile, climatefile, topofile, configfile, outputfile, gridfile):
+    config = load_config(configfile)
+
+    start_execution(config)
+
+    mort = open_folds(mortalityfile)
+    clim = xr.open_zarr(climatefile)
+    topo = xr.open_zarr(topofile)
+    grid = None if gridfile is None else load_grid(gridfile)
+
+    combined = training_dataset(mort, clim, topo, config, grid)
+    precision = config.get('precision', None)
+    combined, deviations = apply_precision(combined, precision)
+
+    write_job = combined.to_zarr(
         outputfile, mode='w', compute=False, consolidated=True
     )
 
     print(f'Writing data...')
-    with ProgressBar():
-        write_job.persist()
+    report = run(checked(write_job, deviations))
+    save_report(outputfile, report, precision)
     print('Done')
 
 
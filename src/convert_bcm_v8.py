@@ -15,7 +15,10 @@ from zipfile import ZipFile
 from datetime import datetime
 from collections import defaultdict
 from werkzeug.security import safe_join
-from dask.diagnostics import ProgressBar
+
+from execution import start_execution, run
+from profiling import profile_option, profiled
+from precision import apply_precision, checked, save_report
 
 
 FILE_RE = '([a-z]{3})([0-9]{4}[a-z]{3})'
@@ -53,6 +56,7 @@ def time_concat(datasets):
     )
 
 
+@profiled('read_archive')
 def read_archive(vinfo, zipfile, chunks):
     last_vname = None
 
@@ -116,6 +120,7 @@ def read_file(vinfo, ascfilename, ascmemfile):
 
 
 @click.command()
+@profile_option
 @click.argument('datadir', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -128,6 +133,7 @@ def read_file(vinfo, ascfilename, ascmemfile):
 def main(datadir, configfile, outputfile):
 
     config = load_config(configfile)
+    start_execution(config)
     vinfo = config['variables']
     chunks = config['chunks']
     pstr = config['projection']
@@ -163,6 +169,9 @@ def main(datadir, configfile, outputfile):
 
     dataset.rio.write_crs(pstr, inplace=True)
 
+    precision = config.get('precision', None)
+    dataset, deviations = apply_precision(dataset, precision)
+
     # Add compression to encoding
     comp = dict(zlib=True, complevel=9)
     for v in dataset.data_vars:
@@ -172,8 +181,8 @@ def main(datadir, configfile, outputfile):
         outputfile, engine='h5netcdf', compute=False
     )
 
-    with ProgressBar():
-        write_job.persist()
+    report = run(checked(write_job, deviations))
+    save_report(outputfile, report, precision)
 
 
 if __name__ == '__main__':
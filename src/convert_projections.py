@@ -4,13 +4,16 @@ import re
 import click
 import rioxarray as rxr
 from pathlib import Path
-from dask.diagnostics import ProgressBar
 
 
 from convert_bcm_v8 import load_config, read_archive
+from execution import start_execution, run
+from profiling import profile_option
+from precision import apply_precision, checked, save_report
 
 
 @click.command()
+@profile_option
 @click.argument('zipfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -23,6 +26,7 @@ from convert_bcm_v8 import load_config, read_archive
 def main(zipfile, configfile, outputfile):
 
     config = load_config(configfile)
+    start_execution(config)
     vinfo = config['variables']
     pstr = config['projection']
     chunks = config['chunks']
@@ -31,6 +35,9 @@ def main(zipfile, configfile, outputfile):
 
     dataset.rio.write_crs(pstr, inplace=True)
 
+    precision = config.get('precision', None)
+    dataset, deviations = apply_precision(dataset, precision)
+
     # Add compression to encoding
     comp = dict(zlib=True, complevel=9)
     for v in dataset.data_vars:
@@ -40,8 +47,8 @@ def main(zipfile, configfile, outputfile):
         outputfile, engine='h5netcdf', compute=False
     )
 
-    with ProgressBar():
-        write_job.persist()
+    report = run(checked(write_job, deviations))
+    save_report(outputfile, report, precision)
 
 
 if __name__ == '__main__':
@@ -2,15 +2,22 @@
 import os
 import json
 import click
+import hashlib
 import numpy as np
 import xarray as xr
 import rasterio as rio
+import rasterio.warp
+import rasterio.features
+import shapely.geometry
 import geopandas as gpd
 import rioxarray as rxr
 from pathlib import Path
 from tqdm import tqdm
 from werkzeug.security import safe_join
-from dask.diagnostics import ProgressBar
+from concurrent.futures import ThreadPoolExecutor
+
+from execution import start_execution, run
+from profiling import profile_option
 
 
 def load_config(configfile):
@@ -22,7 +29,8 @@ def load_variable(fname, vinfo, years):
     invar = vinfo.pop('input')
     name = vinfo.pop('name')
 
-    ds = xr.open_dataset(fname, engine='netcdf4')
+    # Keep the data lazy (and uncached) until it is cropped and chunked
+    ds = xr.open_dataset(fname, engine='netcdf4', cache=False)
 
     # Select/rename variable and add attributes
     var = ds[invar].transpose('northing', 'easting', 'time')
@@ -35,78 +43,242 @@ def load_variable(fname, vinfo, years):
     return var
 
 
-def load_annual_shapefiles(datadir, shapefile_fmt, default_shapefile, years):
+def geometry_cache_file(cache_dir, source, mtime, options):
+    if cache_dir is None:
+        return None
+    key = '|'.join(map(str, (source, mtime, options)))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return safe_join(cache_dir, f'geometry_{digest}.parquet')
+
+
+def read_shapefile(path, cache_dir=None, crs=None, tolerance=None):
+    """
+    Read region geometries, optionally reprojected to `crs` and simplified
+    with `tolerance` (in units of `crs`, e.g., a fraction of the grid
+    resolution). With a `cache_dir`, the processed geometries are stored as
+    GeoParquet keyed by the source file and its modification time.
+    """
+    source = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    options = (str(crs), tolerance)
+
+    cache_file = geometry_cache_file(cache_dir, source, mtime, options)
+    if cache_file is not None and os.path.exists(cache_file):
+        region_df = gpd.read_parquet(cache_file)
+
+    else:
+        region_df = gpd.read_file(path)
+        if crs is not None and region_df.crs != crs:
+            # Same transformation as applied by rio.clip
+            geometries = rio.warp.transform_geom(
+                region_df.crs, crs, region_df.geometry.values
+            )
+            region_df = region_df.set_geometry(
+                [shapely.geometry.shape(g) for g in geometries], crs=crs
+            )
+        if tolerance is not None:
+            region_df = region_df.set_geometry(region_df.simplify(tolerance))
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f'{cache_file}.tmp'
+            region_df.to_parquet(tmp)
+            os.replace(tmp, cache_file)
+
+    # Record the source so rasterized masks can be cached on disk
+    region_df.attrs['source'] = source
+    region_df.attrs['mtime'] = mtime
+    region_df.attrs['options'] = options
+    return region_df
+
+
+def load_annual_shapefiles(datadir, shapefile_fmt, default_shapefile, years,
+        cache_dir=None, crs=None, tolerance=None, workers=None):
+    read_kwargs = dict(cache_dir=cache_dir, crs=crs, tolerance=tolerance)
+
     if default_shapefile is None:
         default_region_df = None
     else:
-        default_region_df = gpd.read_file(safe_join(datadir, default_shapefile))
+        default_region_df = read_shapefile(
+            safe_join(datadir, default_shapefile), **read_kwargs
+        )
+
+    if shapefile_fmt is None:
+        return {}, default_region_df
 
     annual_shapefiles = [
-        safe_join(datadir, shapefile_fmt.format(year=y))
-        for y in years
+        (year, safe_join(datadir, shapefile_fmt.format(year=year)))
+        for year in years
     ]
-
-    region_df_dict = {
-        year: gpd.read_file(sf)
-        for year, sf in tqdm(list(zip(years, annual_shapefiles)), 'Loading Shapefiles')
+    annual_shapefiles = [
+        (year, sf) for year, sf in annual_shapefiles
         if os.path.exists(sf)
-    } if shapefile_fmt is not None else {}
+    ]
+
+    # Shapefile parsing mostly happens outside of the GIL
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(read_shapefile, sf, **read_kwargs)
+            for _, sf in annual_shapefiles
+        ]
+        region_df_dict = {
+            year: future.result()
+            for (year, _), future in tqdm(
+                list(zip(annual_shapefiles, futures)), 'Loading Shapefiles'
+            )
+        }
 
     return region_df_dict, default_region_df
 
 
-def apply_masks(dataset, region_df_dict, default_region_df, years):
+def mask_cache_file(cache_dir, region_df, transform, shape, crs):
+    if cache_dir is None or 'source' not in region_df.attrs:
+        return None
+    key = '|'.join(map(str, (
+        region_df.attrs['source'], region_df.attrs['mtime'],
+        region_df.attrs.get('options', None), tuple(transform), shape, crs,
+    )))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return safe_join(cache_dir, f'mask_{digest}.npy')
+
+
+def region_mask(dataset, region_df, cache_dir=None):
+    """
+    Rasterize the region geometries onto the dataset grid (True inside),
+    using the same rules as `rio.clip`
+    """
+    transform = dataset.rio.transform(recalc=True)
+    shape = (int(dataset.rio.height), int(dataset.rio.width))
+
+    cache_file = mask_cache_file(
+        cache_dir, region_df, transform, shape, dataset.rio.crs
+    )
+    if cache_file is not None and os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    geometries = region_df.geometry.values
+    if region_df.crs != dataset.rio.crs:
+        geometries = rio.warp.transform_geom(
+            region_df.crs, dataset.rio.crs, geometries
+        )
+    mask = rio.features.geometry_mask(
+        geometries, out_shape=shape, transform=transform, invert=True
+    )
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_file, mask)
+
+    return mask
+
+
+def mask_extent(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    return rows[0], rows[-1], cols[0], cols[-1]
+
+
+def all_extents_equal(masks):
+    extents = [mask_extent(m) for m in masks]
+    return all(e == extents[0] for e in extents)
+
+
+def apply_masks(dataset, region_df_dict, default_region_df, years,
+        cache_dir=None, chunks=None):
+    """
+    Mask (and crop) the dataset to the region geometries. If `chunks` is
+    given, the cropped data is chunked before masking, so masking is done
+    lazily, block by block.
+    """
 
     # If no shapefiles are provided, do not modify dataset
     if len(region_df_dict) == 0 and default_region_df is None:
         return dataset
 
-    print('Fill NaN...')
-    dataset = dataset.fillna(0.0)
-    print('...done.')
     dataset = dataset.rename({ 'easting': 'x', 'northing': 'y' })
 
     if len(region_df_dict) == 0:
-        dataset = dataset.rio.clip(
-            default_region_df.geometry.values, default_region_df.crs
+        mask = xr.DataArray(
+            region_mask(dataset, default_region_df, cache_dir),
+            dims=('y', 'x'),
         )
 
     else:
-        dataset = xr.concat([
-            dataset.sel(year=y).rio.clip(
-                region_df_dict.get(y, default_region_df).geometry.values,
-                region_df_dict.get(y, default_region_df).crs
-            )
-            for y in tqdm(years, 'Applying Masks')
-            ],
-            dim='year',
-            data_vars='all',
-            coords='different',
+        # Each distinct set of geometries is rasterized only once
+        masks = {}
+        layers = []
+        for y in tqdm(years, 'Building Masks'):
+            region_df = region_df_dict.get(y, default_region_df)
+            if id(region_df) not in masks:
+                masks[id(region_df)] = region_mask(
+                    dataset, region_df, cache_dir
+                )
+            layers.append(masks[id(region_df)])
+        mask = xr.DataArray(
+            np.stack(layers), dims=('year', 'y', 'x'),
+            coords={ 'year': years },
         )
 
+    # Crop to the extent covered by any mask, as rio.clip does
+    covered = mask.any(dim=[d for d in mask.dims if d != 'y']).values
+    rows = np.flatnonzero(covered)
+    covered = mask.any(dim=[d for d in mask.dims if d != 'x']).values
+    cols = np.flatnonzero(covered)
+    if len(rows) == 0 or len(cols) == 0:
+        raise ValueError('No data found within the region masks')
+    window = {
+        'y': slice(rows[0], rows[-1] + 1),
+        'x': slice(cols[0], cols[-1] + 1),
+    }
+    dataset = dataset.isel(window)
+    mask = mask.isel(window)
+
+    if chunks is not None:
+        chunks = {
+            { 'easting': 'x', 'northing': 'y' }.get(k, k): v
+            for k, v in chunks.items()
+        }
+        dataset = dataset.chunk(chunks)
+        mask = mask.chunk({ k: v for k, v in chunks.items() if k in mask.dims })
+
+    print('Fill NaN...')
+    dataset = dataset.fillna(0.0)
+    print('...done.')
+    dataset = dataset.where(mask)
+
+    if len(region_df_dict) > 0:
+        # Keep the layout of the existing annual mortality stores: year
+        # first, and the union of differing yearly extents sorted ascending
+        dataset = dataset.transpose('year', ...)
+        if len(masks) > 1 and not all_extents_equal(list(masks.values())):
+            dataset = dataset.sortby(['y', 'x'])
+
+    # The CF coordinate attributes and transform rio.clip writes
+    dataset = dataset.rio.write_coordinate_system()
+    dataset = dataset.rio.write_transform(dataset.rio.transform(recalc=True))
+
     dataset = dataset.rename({ 'x': 'easting', 'y': 'northing' })
     return dataset
 
 
-@click.command()
-@click.argument('datadir', type=click.Path(
-    path_type=Path, exists=True
-))
-@click.argument('configfile', type=click.Path(
-    path_type=Path, exists=True
-))
-@click.argument('outputfile', type=click.Path(
-    path_type=Path, exists=False
-))
-def main(datadir, configfile, outputfile):
-
-    config = load_config(configfile)
+def convert_mortality(datadir, config):
+    """
+    Load the mortality variables in `datadir` as a lazy dataset masked to
+    the survey regions
+    """
     years = config['years']
     vinfo = config['variables']
     chunks = config['chunks']
     pstr = config['projection']
     region_shapefile = config.get('region_shapefile', None)
     annual_region_shapefile_fmt = config.get('region_annual_shapefile', None)
+    mask_cache_dir = config.get('mask_cache_dir', None)
+    if mask_cache_dir is not None:
+        mask_cache_dir = safe_join(datadir, mask_cache_dir)
+    geometry_cache_dir = config.get('geometry_cache_dir', None)
+    if geometry_cache_dir is not None:
+        geometry_cache_dir = safe_join(datadir, geometry_cache_dir)
+    geometry_tolerance = config.get('geometry_tolerance', None)
 
     variables = []
     for fname, vi in tqdm(list(vinfo.items()), 'Loading Variables'):
@@ -117,21 +289,45 @@ def main(datadir, configfile, outputfile):
     years = dataset.year.values
 
     region_df_dict, default_region_df = load_annual_shapefiles(
-        datadir, annual_region_shapefile_fmt, region_shapefile, years
+        datadir, annual_region_shapefile_fmt, region_shapefile, years,
+        cache_dir=geometry_cache_dir, crs=pstr, tolerance=geometry_tolerance
     )
 
     dataset.rio.write_crs(pstr, inplace=True)
 
-    dataset = apply_masks(dataset, region_df_dict, default_region_df, years)
+    # Variables are opened lazily; data is only read chunk by chunk when
+    # the output is written
+    dataset = apply_masks(
+        dataset, region_df_dict, default_region_df, years, mask_cache_dir,
+        chunks=chunks
+    )
+
+    return dataset.chunk(chunks)
+
+
+@click.command()
+@profile_option
+@click.argument('datadir', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('configfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('outputfile', type=click.Path(
+    path_type=Path, exists=False
+))
+def main(datadir, configfile, outputfile):
+
+    config = load_config(configfile)
+    start_execution(config)
 
-    dataset = dataset.chunk(chunks)
+    dataset = convert_mortality(datadir, config)
 
     write_job = dataset.to_zarr(
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
 
 
 if __name__ == '__main__':
@@ -2,47 +2,220 @@
 import os
 import click
 import warnings
+import functools
 import numpy as np
 import xarray as xr
+import dask.array as da
 from tqdm import tqdm
 from pathlib import Path
 from werkzeug.security import safe_join
-from dask.diagnostics import ProgressBar
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from util import load_config
+from execution import start_execution, run
+from profiling import profile_option
 
 DEFAULT_SHIFT = np.timedelta64(1, 'm').astype('timedelta64[m]')
+HOURS_PER_DAY = 24
+DAYS_PER_YEAR = 365
+# Zero-based day of year of February 29th in leap years
+LEAP_DAY = 59
+
+
+def count_valid(a, axis):
+    return np.sum(~np.isnan(a), axis=axis)
+
+
+# Statistics as computed by xarray reductions, skipping NaN values and not
+STATISTICS = {
+    'count': (count_valid, count_valid),
+    'sum': (np.nansum, np.sum),
+    'prod': (np.nanprod, np.prod),
+    'mean': (np.nanmean, np.mean),
+    'median': (np.nanmedian, np.median),
+    'quantile': (np.nanquantile, np.quantile),
+    'min': (np.nanmin, np.min),
+    'max': (np.nanmax, np.max),
+    'std': (np.nanstd, np.std),
+    'var': (np.nanvar, np.var),
+}
 
 
 def shift_backwards(dt, shift=DEFAULT_SHIFT):
     return (dt.astype('datetime64[m]') - shift).astype('datetime64[ns]')
 
 
-def adjust_leap_year(ds):
-    if ds.dims['dayofyear'] > 365:
-        ds = ds.drop_sel(dayofyear=60)
-        ds = ds.assign_coords(dayofyear=np.arange(1, 366, dtype=int))
-    return ds
+def day_index(ndays):
+    """
+    Map the days of a year onto a 365-day calendar, dropping February 29th
+    """
+    days = np.arange(ndays)
+    if ndays > DAYS_PER_YEAR:
+        days = days[days != LEAP_DAY]
+    return days
+
+
+def daily_statistic(function, kwargs):
+    """
+    The reduction for a statistic and its keyword arguments (as for the
+    xarray reduction of the same name, e.g., `skipna`, `ddof` or `q`)
+    """
+    if function not in STATISTICS:
+        raise ValueError(
+            f'Unsupported statistic "{function}", expected one of '
+            f'{", ".join(STATISTICS)}'
+        )
+    kwargs = dict(kwargs)
+    skipna = kwargs.pop('skipna', True)
+    if function == 'count':
+        kwargs = {}
+    nanfunc, func = STATISTICS[function]
+    return functools.partial(nanfunc if skipna else func, **kwargs)
+
+
+def daily_block(block, statistics):
+    """
+    Reduce one year of hourly values (time first) to daily statistics by
+    reshaping the time axis into (day, 24) and reducing over the hours.
+    All statistics are stacked along a new leading axis.
+    """
+    ndays, remainder = divmod(block.shape[0], HOURS_PER_DAY)
+    if remainder != 0:
+        raise ValueError(
+            f'Expected whole days of hourly data, found {block.shape[0]} hours'
+        )
+
+    days = block.reshape((ndays, HOURS_PER_DAY) + block.shape[1:])
+    days = days[day_index(ndays)]
+
+    results = [
+        daily_statistic(function, kwargs)(days, axis=1)
+        for function, kwargs in statistics
+    ]
+    return np.stack(results, axis=0).astype(block.dtype, copy=False)
+
+
+def year_bounds(times, year):
+    year_start = np.datetime64(f'{year}-01-01', 'ns')
+    year_end = np.datetime64(f'{year + 1}-01-01', 'ns')
+    return (
+        int(np.searchsorted(times, year_start, side='left')),
+        int(np.searchsorted(times, year_end, side='left')),
+    )
+
 
+def get_annual_stats(ds, years, stats):
+    """
+    Compute the daily statistics of every year, with one kernel task per
+    spatial chunk and year computing all statistics of a variable
+    """
+    times = ds.time.values
+    bounds = [year_bounds(times, year) for year in years]
 
-def get_annual_stats(ds, year, stats):
-    ds = ds.sel(time=(ds.time.dt.year == year))
-    groups = ds.groupby('time.dayofyear')
     stat_vars = []
-    for sd in stats:
-        var = sd['variable']
-        name = sd['name']
-        function = sd['function']
-        kwargs = sd.get('kwargs', {})
-        stat_var = getattr(groups, function)(**kwargs)[var]
-        stat_var.attrs.update(**sd.get('attrs', {}))
-        stat_vars.append(stat_var.rename(name))
-    annual_stats = xr.merge(stat_vars, combine_attrs='drop_conflicts')
-    annual_stats = adjust_leap_year(annual_stats)
-    return annual_stats.expand_dims(dim={'year': [year]}, axis=1)
+    for var in dict.fromkeys(sd['variable'] for sd in stats):
+        vstats = [sd for sd in stats if sd['variable'] == var]
+        args = [(sd['function'], sd.get('kwargs', {})) for sd in vstats]
+
+        hourly = ds[var].transpose('time', ...)
+        data = hourly.data
+        if not isinstance(data, da.Array):
+            data = da.from_array(data)
+
+        annual = []
+        for start, stop in bounds:
+            year_data = data[start:stop].rechunk({0: -1})
+            annual.append(da.map_blocks(
+                daily_block, year_data, statistics=args,
+                new_axis=0,
+                chunks=(
+                    ((len(args),), (DAYS_PER_YEAR,)) + year_data.chunks[1:]
+                ),
+                dtype=hourly.dtype,
+            ))
+        combined = da.stack(annual, axis=2)
+
+        spatial_dims = hourly.dims[1:]
+        coords = {
+            'dayofyear': np.arange(1, DAYS_PER_YEAR + 1, dtype=int),
+            'year': list(years),
+        }
+        coords.update({
+            k: v for k, v in hourly.coords.items() if 'time' not in v.dims
+        })
+        for i, sd in enumerate(vstats):
+            stat_vars.append(xr.DataArray(
+                combined[i], dims=('dayofyear', 'year') + spatial_dims,
+                coords=coords, name=sd['name'], attrs=sd.get('attrs', {}),
+            ))
+
+    return xr.merge(stat_vars, combine_attrs='drop_conflicts')
+
+
+def init_output(outputfile, erafile, years, stats, chunks):
+    """
+    Write the metadata and coordinates of the output store so that each
+    year can later be written into its own region
+    """
+    with xr.open_dataset(erafile) as ds:
+        stat_vars = {}
+        for sd in stats:
+            var = ds[sd['variable']].transpose('time', ...)
+            spatial_dims = var.dims[1:]
+            shape = (DAYS_PER_YEAR, len(years)) + var.shape[1:]
+            stat_vars[sd['name']] = (
+                ('dayofyear', 'year') + spatial_dims,
+                da.zeros(shape, dtype=var.dtype),
+                sd.get('attrs', {}),
+            )
+        coords = {
+            'dayofyear': np.arange(1, DAYS_PER_YEAR + 1, dtype=int),
+            'year': list(years),
+        }
+        coords.update({
+            d: ds[d].values for d in spatial_dims if d in ds.coords
+        })
+
+    template = xr.Dataset(data_vars=stat_vars, coords=coords)
+    template.chunk(chunks).to_zarr(
+        outputfile, mode='w', compute=False, consolidated=True
+    )
+
+
+def process_year(eradir, suffix, year, year_idx, stats, outputfile):
+    """
+    Compute one year of daily statistics from its own file plus the first
+    hour of the next one, and write them into the year's output region
+    """
+    with xr.open_dataset(safe_join(eradir, f'{year}.{suffix}')) as cur, \
+            xr.open_dataset(safe_join(eradir, f'{year + 1}.{suffix}')) as nxt:
+        ds = xr.concat(
+            [cur, nxt.isel(time=slice(0, 1))], dim='time',
+            data_vars='all', join='override'
+        )
+        ds = ds.assign_coords(time=shift_backwards(ds.time.values))
+        start, stop = year_bounds(ds.time.values, year)
+
+        stat_vars = {}
+        for var in dict.fromkeys(sd['variable'] for sd in stats):
+            vstats = [sd for sd in stats if sd['variable'] == var]
+            args = [(sd['function'], sd.get('kwargs', {})) for sd in vstats]
+            hourly = ds[var].transpose('time', ...)
+            values = daily_block(hourly.values[start:stop], args)
+            dims = ('dayofyear', 'year') + hourly.dims[1:]
+            for value, sd in zip(values, vstats):
+                stat_vars[sd['name']] = (dims, value[:, np.newaxis, ...])
+
+    annual = xr.Dataset(data_vars=stat_vars)
+    annual.to_zarr(
+        outputfile, region={'year': slice(year_idx, year_idx + 1)},
+        mode='r+', consolidated=False
+    )
+    return year
 
 
 @click.command()
+@profile_option
 @click.argument('eradir', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -63,6 +236,14 @@ def main(eradir, configfile, outputfile):
     suffix = config.get('suffix', 'nc')
     stats = config['stats']
     chunks = config['chunks']
+    mode = config.get('mode', 'combined')
+    workers = config.get('workers', None)
+
+    if mode not in ('combined', 'per_year'):
+        raise ValueError(f'Unknown mode "{mode}"')
+
+    for sd in stats:
+        daily_statistic(sd['function'], sd.get('kwargs', {}))
 
     # Need to add 2: 1 so it is inclusive of the end year, and another 1 so the
     # first hour of the following year in shifted backwards to the end year
@@ -80,19 +261,37 @@ def main(eradir, configfile, outputfile):
     if len(missing) > 0:
         raise ValueError(f'Missing the following files: {", ".join(missing)}')
 
+    years = list(range(year_range[0], year_range[1] + 1))
+
+    if mode == 'per_year':
+        # Each year is written to its own chunk, so workers never share one
+        if chunks.get('year', 1) != 1:
+            print('Using a year chunk size of 1 for per-year output')
+        chunks = dict(chunks, year=1)
+
+        init_output(outputfile, erafiles[0], years, stats, chunks)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    process_year, eradir, suffix, year, i, stats, outputfile
+                )
+                for i, year in enumerate(years)
+            ]
+            for future in tqdm(as_completed(futures), 'Annual Stats',
+                    total=len(futures)):
+                future.result()
+        return
+
+    start_execution(config)
+
     erads = xr.open_mfdataset(erafiles, join='override', parallel=True)
 
     # Shift times backwards by 1 hour so midnight belongs to previous day
     new_times = shift_backwards(erads.time.values)
     erads = erads.assign_coords(time=new_times)
 
-    year_range_args = [year_range[0], year_range[1] + 1]
-    annual_stats = [
-        get_annual_stats(erads, year, stats)
-        for year in tqdm(list(range(*year_range_args)), 'Annual Stats')
-    ]
-
-    combined_stats = xr.merge(annual_stats, combine_attrs='drop_conflicts')
+    combined_stats = get_annual_stats(erads, years, stats)
 
     print(combined_stats)
 
@@ -100,8 +299,7 @@ def main(eradir, configfile, outputfile):
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
 
 
 if __name__ == '__main__':
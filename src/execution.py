@@ -0,0 +1,126 @@
+"""
+EcoPro Tree Mortality
+Dask Execution Context
+"""
+import os
+import atexit
+import contextlib
+import dask
+from dask.diagnostics import ProgressBar
+from distributed import Client, LocalCluster, get_client, progress
+
+from util import load_config
+from profiling import phase
+
+
+# Pipeline-wide execution config used by scripts without their own section
+CONFIG_ENV = 'ECOPRO_DASK_CONFIG'
+
+# Worker memory thresholds, as fractions of the memory limit
+MEMORY_FRACTIONS = {
+    'memory_target': 'distributed.worker.memory.target',
+    'memory_spill': 'distributed.worker.memory.spill',
+    'memory_pause': 'distributed.worker.memory.pause',
+    'memory_terminate': 'distributed.worker.memory.terminate',
+}
+
+
+def execution_config(config=None):
+    """
+    Return the `dask_client` or `dask_slurm` section of a script config,
+    falling back to the file named by the ECOPRO_DASK_CONFIG variable
+    """
+    for c in (config or {}), shared_config():
+        for key in ('dask_client', 'dask_slurm'):
+            if c.get(key, None) is not None:
+                return key, dict(c[key])
+    return None, None
+
+
+def shared_config():
+    configfile = os.environ.get(CONFIG_ENV, None)
+    if configfile is None:
+        return {}
+    return load_config(configfile)
+
+
+def start_cluster(kind, settings):
+    if kind == 'dask_slurm':
+        from dask_jobqueue import SLURMCluster
+        n_workers = settings.pop('n_workers', 1)
+        cluster = SLURMCluster(**settings)
+        cluster.scale(n_workers)
+        return cluster
+
+    dask.config.set({
+        MEMORY_FRACTIONS[k]: settings.pop(k)
+        for k in list(settings) if k in MEMORY_FRACTIONS
+    })
+    return LocalCluster(**settings)
+
+
+def start_client(config=None):
+    """
+    Connect to the scheduler or start the cluster described by the config.
+    Returns None (and the threaded scheduler is used) if there is none.
+    """
+    kind, settings = execution_config(config)
+    address = dask.config.get('scheduler-address', None)
+    if settings is not None:
+        address = settings.pop('address', address)
+
+    if address is not None:
+        return Client(address)
+    if settings is None:
+        return None
+
+    cluster = start_cluster(kind, settings)
+    client = Client(cluster)
+    print(f'Dask dashboard: {client.dashboard_link}')
+    return client
+
+
+@contextlib.contextmanager
+def execution_context(config=None):
+    client = start_client(config)
+    try:
+        yield client
+    finally:
+        if client is not None:
+            cluster = client.cluster
+            client.close()
+            if cluster is not None:
+                cluster.close()
+
+
+def start_execution(config=None):
+    """
+    Set up the execution context for the rest of a script
+    """
+    stack = contextlib.ExitStack()
+    client = stack.enter_context(execution_context(config))
+    atexit.register(stack.close)
+    return client
+
+
+def current_client():
+    try:
+        return get_client()
+    except ValueError:
+        return None
+
+
+def run(job, name='compute', writes=()):
+    """
+    Compute a job (e.g., a delayed write) with a progress bar on the
+    active scheduler, recorded as a profiling phase
+    """
+    with phase(name, writes=writes):
+        client = current_client()
+        if client is None:
+            with ProgressBar():
+                return job.compute()
+
+        future = client.compute(job)
+        progress(future)
+        return future.result()
@@ -1,48 +1,212 @@
 #!/usr/bin/env python
 import os
+import json
 import click
 import cdsapi
+import hashlib
+import tempfile
+import threading
+import xarray as xr
 from tqdm import tqdm
 from pathlib import Path
 from werkzeug.security import safe_join
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from util import load_config
+from profiling import profile_option
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_checksum(path, blocksize=2**20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    tmp = f'{manifest_path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, manifest_path)
+
+
+def is_complete(manifest, outfile, verify=False):
+    """
+    A file only counts as downloaded if the manifest records it and the
+    file on disk still matches the recorded size (and checksum, if verified)
+    """
+    entry = manifest.get(os.path.basename(outfile), None)
+    if entry is None or not os.path.exists(outfile):
+        return False
+    if os.path.getsize(outfile) != entry['size']:
+        return False
+    if verify and file_checksum(outfile) != entry['sha256']:
+        return False
+    return True
+
+
+def opens_cleanly(path):
+    """
+    Whether a file opens and the last element of each variable (the end of
+    a truncated file) can be read
+    """
+    try:
+        with xr.open_dataset(path) as ds:
+            for var in ds.data_vars.values():
+                var[(-1,) * var.ndim].load()
+    except Exception:
+        return False
+    return True
+
+
+def seed_manifest(manifest, paths):
+    """
+    Record existing files that are not in the manifest (e.g., downloaded
+    before there was one) if they open cleanly. Returns whether any were
+    added.
+    """
+    seeded = False
+    for _, outfile in paths:
+        name = os.path.basename(outfile)
+        if name in manifest or not os.path.exists(outfile):
+            continue
+        if opens_cleanly(outfile):
+            manifest[name] = {
+                'size': os.path.getsize(outfile),
+                'sha256': file_checksum(outfile),
+            }
+            seeded = True
+    return seeded
+
+
+def atomic_retrieve(client, dataset, request, outfile):
+    """
+    Retrieve into a temporary file in the output directory, then rename it
+    into place so interrupted downloads never leave a partial output file
+    """
+    outdir = os.path.dirname(outfile)
+    fd, tmp = tempfile.mkstemp(suffix='.part', dir=outdir)
+    os.close(fd)
+    try:
+        client.retrieve(dataset, request, tmp)
+        os.replace(tmp, outfile)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def fetch_year(client, dataset, query_params, year, outfile, split_months):
+    request = dict(query_params, year=year)
+
+    if not split_months:
+        atomic_retrieve(client, dataset, request, outfile)
+        return
+
+    # Smaller monthly requests are queued faster by the CDS; they are
+    # combined into the yearly file afterwards. Splitting is set in the
+    # config, not triggered by queue times.
+    outdir = os.path.dirname(outfile)
+    with tempfile.TemporaryDirectory(dir=outdir) as tmpdir:
+        monthfiles = []
+        for month in query_params['month']:
+            monthfile = os.path.join(tmpdir, f'{year}_{month}.nc')
+            client.retrieve(dataset, dict(request, month=month), monthfile)
+            monthfiles.append(monthfile)
+
+        combined = os.path.join(tmpdir, 'combined.nc')
+        with xr.open_mfdataset(monthfiles, combine='by_coords') as ds:
+            ds.to_netcdf(combined)
+        os.replace(combined, outfile)
+
+
+def download_all(client_factory, dataset, query_params, paths, manifest_path,
+        workers=1, split_months=False):
+    """
+    Fetch all (year, path) pairs with a bounded pool of concurrent requests.
+    Each thread uses its own client from `client_factory`, so a local
+    stand-in for `cdsapi.Client` can be used in place of the CDS.
+    """
+    manifest = load_manifest(manifest_path)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def task(year, outfile):
+        if not hasattr(local, 'client'):
+            local.client = client_factory()
+        fetch_year(
+            local.client, dataset, query_params, year, outfile, split_months
+        )
+        entry = {
+            'size': os.path.getsize(outfile),
+            'sha256': file_checksum(outfile),
+        }
+        with lock:
+            manifest[os.path.basename(outfile)] = entry
+            save_manifest(manifest, manifest_path)
+        return outfile
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(task, y, p) for y, p in paths]
+        for future in tqdm(as_completed(futures), 'Fetching Data',
+                total=len(futures)):
+            future.result()
 
 
 @click.command()
+@profile_option
 @click.argument('configfile', type=click.Path(
     path_type=Path, exists=True
 ))
 @click.argument('outputdir', type=click.Path(
     path_type=Path
 ))
-def main(configfile, outputdir):
+@click.option('--verify', is_flag=True, default=False,
+    help='Verify checksums of previously downloaded files')
+def main(configfile, outputdir, verify):
 
     config = load_config(configfile)
     years = list(range(*config['years']))
     out_fmt = config['output_format']
     dataset = config['dataset']
     query_params = config['query_parameters']
+    workers = config.get('workers', 1)
+    split_months = config.get('split_months', False)
 
     if not os.path.exists(outputdir):
         os.mkdir(outputdir)
 
-    c = cdsapi.Client()
+    manifest_path = safe_join(outputdir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
 
     paths = [
         (year, safe_join(outputdir, out_fmt.format(year=year)))
         for year in years
     ]
 
-    # Only download files that have not yet been fetched
+    if seed_manifest(manifest, paths):
+        save_manifest(manifest, manifest_path)
+
+    # Only download files that have not been completely fetched
     paths = [
         (y, p) for y, p in paths
-        if not os.path.exists(p)
+        if not is_complete(manifest, p, verify=verify)
     ]
 
-    for year, outfile in tqdm(paths, 'Fetching Data'):
-        query_params['year'] = year
-        c.retrieve(dataset, query_params, outfile)
+    download_all(
+        cdsapi.Client, dataset, query_params, paths, manifest_path,
+        workers=workers, split_months=split_months
+    )
 
 
 if __name__ == '__main__':
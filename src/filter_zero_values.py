@@ -3,10 +3,29 @@ import click
 import json
 import xarray as xr
 from pathlib import Path
-from dask.diagnostics import ProgressBar
+
+from execution import start_execution, run
+from profiling import profile_option
+
+
+def nonzero_samples(ds, config):
+    """
+    Select the samples with a positive target, keeping the input chunking
+    """
+    target = config['target']
+    chunks = {
+        k: v[0] for k, v in ds.chunksizes.items()
+    }
+
+    print(f'Selecting data...')
+    new = ds.where((ds[target] > 0).compute(), drop=True)
+    print('...done.')
+
+    return new.chunk(chunks)
 
 
 @click.command()
+@profile_option
 @click.argument('trainingfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -22,25 +41,18 @@ def main(trainingfile, configfile, outputfile):
     with open(configfile, 'r') as f:
         config = json.load(f)
 
-    target = config['target']
+    start_execution(config)
 
     ds = xr.open_zarr(trainingfile)
-    chunks = {
-        k: v[0] for k, v in ds.chunksizes.items()
-    }
-
-    print(f'Selecting data...')
-    new = ds.where((ds[target] > 0).compute(), drop=True)
-    print('...done.')
+    new = nonzero_samples(ds, config)
 
-    write_job = new.chunk(chunks).to_zarr(
+    write_job = new.to_zarr(
         outputfile, mode='w', consolidated=True,
         compute=False
     )
 
     print(f'Writing data...')
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
     print('...done.')
 
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import json
+import click
+import numpy as np
+import xarray as xr
+import rioxarray
+from affine import Affine
+from rasterio.crs import CRS
+from pathlib import Path
+
+from profiling import profile_option
+
+
+# Maximum misalignment with the grid, as a fraction of a cell
+GRID_TOLERANCE = 1e-3
+
+
+def regular_step(values, name):
+    steps = np.diff(values)
+    step = np.median(steps)
+    if np.any(np.abs(steps - step) > GRID_TOLERANCE * abs(step)):
+        raise ValueError(f'Coordinate {name} is not regularly spaced')
+    return step
+
+
+def grid_from_dataset(ds, xdim='easting', ydim='northing'):
+    """
+    Describe the grid of a dataset as a north-up affine transform of cell
+    corners, a shape, and a CRS
+    """
+    x = np.sort(ds[xdim].values)
+    y = np.sort(ds[ydim].values)[::-1]
+    dx = regular_step(x, xdim)
+    dy = regular_step(y, ydim)
+    crs = ds.rio.crs
+    return {
+        'transform': list(Affine(
+            dx, 0.0, x[0] - dx / 2, 0.0, dy, y[0] - dy / 2
+        ))[:6],
+        'shape': [len(y), len(x)],
+        'crs': None if crs is None else crs.to_wkt(),
+    }
+
+
+def save_grid(grid, gridfile):
+    with open(gridfile, 'w') as f:
+        json.dump(grid, f, indent=2)
+
+
+def load_grid(gridfile):
+    with open(gridfile, 'r') as f:
+        return json.load(f)
+
+
+def grid_positions(values, origin, step, name):
+    """
+    Integer cell positions of coordinate values on the grid axis
+    """
+    pos = (np.asarray(values) - origin) / step - 0.5
+    idx = np.rint(pos)
+    if np.any(np.abs(pos - idx) > GRID_TOLERANCE):
+        raise ValueError(f'Coordinate {name} is not aligned with the grid')
+    return idx.astype(int)
+
+
+def check_grid(ds, grid, xdim='easting', ydim='northing'):
+    """
+    Verify that a dataset has the resolution and CRS of the grid
+    """
+    other = grid_from_dataset(ds, xdim, ydim)
+    a = Affine(*grid['transform'])
+    b = Affine(*other['transform'])
+    if (
+        abs(a.a - b.a) > GRID_TOLERANCE * abs(a.a)
+        or abs(a.e - b.e) > GRID_TOLERANCE * abs(a.e)
+    ):
+        raise ValueError(
+            f'Resolution ({b.a}, {b.e}) does not match the grid ({a.a}, {a.e})'
+        )
+    if grid['crs'] is not None and other['crs'] is not None:
+        if CRS.from_wkt(other['crs']) != CRS.from_wkt(grid['crs']):
+            raise ValueError('CRS does not match the grid')
+
+
+def as_slice(idx):
+    """
+    Use a slice for contiguous ascending positions to keep selections lazy
+    """
+    if len(idx) > 0 and np.all(np.diff(idx) == 1):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+
+def align_to_grid(datasets, grid, xdim='easting', ydim='northing'):
+    """
+    Select the cells shared by all datasets by their integer positions on
+    the grid and give them identical grid coordinates, so the datasets can
+    be combined without matching floating point coordinates
+    """
+    transform = Affine(*grid['transform'])
+    positions = []
+    for ds in datasets:
+        check_grid(ds, grid, xdim, ydim)
+        positions.append((
+            grid_positions(ds[xdim].values, transform.c, transform.a, xdim),
+            grid_positions(ds[ydim].values, transform.f, transform.e, ydim),
+        ))
+
+    cols = positions[0][0]
+    rows = positions[0][1]
+    for c, r in positions[1:]:
+        cols = np.intersect1d(cols, c)
+        rows = np.intersect1d(rows, r)
+    if len(cols) == 0 or len(rows) == 0:
+        raise ValueError('Datasets do not overlap on the grid')
+
+    coords = {
+        xdim: transform.c + (cols + 0.5) * transform.a,
+        ydim: transform.f + (rows + 0.5) * transform.e,
+    }
+
+    aligned = []
+    for ds, (c, r) in zip(datasets, positions):
+        c_order = np.argsort(c)
+        r_order = np.argsort(r)
+        aligned.append(ds.isel({
+            xdim: as_slice(c_order[np.searchsorted(c[c_order], cols)]),
+            ydim: as_slice(r_order[np.searchsorted(r[r_order], rows)]),
+        }).assign_coords(coords))
+
+    return aligned
+
+
+@click.command()
+@profile_option
+@click.argument('datasetfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('gridfile', type=click.Path(
+    path_type=Path, exists=False
+))
+def main(datasetfile, gridfile):
+    """
+    Register the grid of a dataset (e.g., the annual BCM dataset)
+    """
+    ds = xr.open_zarr(datasetfile)
+    save_grid(grid_from_dataset(ds), gridfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,15 @@ import os
 import click
 import xarray as xr
 from pathlib import Path
-from dask.diagnostics import ProgressBar
 
 from convert_bcm_v8 import load_config
+from execution import start_execution, run
+from profiling import profile_option
+from precision import apply_precision, checked, save_report
 
 
 @click.command()
+@profile_option
 @click.argument('variablefiles', nargs=-1, type=click.Path(
     path_type=Path, exists=True
 ))
@@ -21,6 +24,7 @@ from convert_bcm_v8 import load_config
 def main(variablefiles, configfile, outputfile):
 
     config = load_config(configfile)
+    start_execution(config)
     chunks = config['chunks']
 
     dataset = xr.open_mfdataset(
@@ -29,12 +33,15 @@ def main(variablefiles, configfile, outputfile):
 
     dataset = dataset.chunk(chunks)
 
+    precision = config.get('precision', None)
+    dataset, deviations = apply_precision(dataset, precision)
+
     write_job = dataset.to_zarr(
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    report = run(checked(write_job, deviations))
+    save_report(outputfile, report, precision)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,116 @@
 #!/usr/bin/env python
-import os
 import json
 import click
 import warnings
+import numpy as np
 import xarray as xr
+import rioxarray
+import dask.array as da
 from pathlib import Path
-from dask.diagnostics import ProgressBar
+
+from execution import start_execution, run
+from profiling import profile_option
+from chunking import resolve_chunks, write_series_copy
+
+
+REDUCTIONS = ('mean', 'var', 'std', 'min', 'max', 'sum', 'count')
+ORDER_STATISTICS = ('median', 'quantile')
+
+
+def ensemble_block(*members, statistics=()):
+    """
+    Compute every requested statistic for one spatial block in a single pass
+    over the ensemble members. Mean and variance use Welford's update, so
+    only the order statistics require all members to be held at once.
+    """
+    shape = members[0].shape
+    count = np.zeros(shape, dtype=int)
+    mean = np.zeros(shape)
+    m2 = np.zeros(shape)
+    total = np.zeros(shape)
+    vmin = np.full(shape, np.nan)
+    vmax = np.full(shape, np.nan)
+
+    for m in members:
+        valid = np.logical_not(np.isnan(m))
+        count += valid
+        delta = np.where(valid, m - mean, 0.0)
+        mean += delta / np.maximum(count, 1)
+        m2 += np.where(valid, delta * (m - mean), 0.0)
+        total += np.where(valid, m, 0.0)
+        vmin = np.fmin(vmin, m)
+        vmax = np.fmax(vmax, m)
+
+    empty = (count == 0)
+    stacked = None
+    results = []
+    for statistic, kwargs in statistics:
+        if statistic == 'mean':
+            value = np.where(empty, np.nan, mean)
+        elif statistic in ('var', 'std'):
+            ddof = kwargs.get('ddof', 0)
+            dof = count - ddof
+            value = np.where(dof > 0, m2 / np.maximum(dof, 1), np.nan)
+            if statistic == 'std':
+                value = np.sqrt(value)
+        elif statistic == 'min':
+            value = vmin
+        elif statistic == 'max':
+            value = vmax
+        elif statistic == 'sum':
+            value = total
+        elif statistic == 'count':
+            value = count.astype(float)
+        else:
+            if stacked is None:
+                stacked = np.stack(members, axis=0)
+            q = 0.5 if statistic == 'median' else kwargs['q']
+            value = np.nanquantile(stacked, q, axis=0)
+
+        if not kwargs.get('skipna', True):
+            value = np.where(count == len(members), value, np.nan)
+
+        results.append(value)
+
+    return np.stack(results, axis=0)
+
+
+def ensemble_statistics(arrays, statistics):
+    """
+    Reduce a list of aligned ensemble member arrays to one array per
+    statistic, all produced by a single blockwise task per chunk
+    """
+    for s in statistics:
+        if s['statistic'] not in REDUCTIONS + ORDER_STATISTICS:
+            raise ValueError(f'Unsupported statistic "{s["statistic"]}"')
+        if np.ndim(s.get('kwargs', {}).get('q', 0)) > 0:
+            raise ValueError('Only scalar quantiles are supported')
+
+    template = arrays[0]
+    members = [
+        a.transpose(*template.dims).data.rechunk(template.data.chunks)
+        for a in arrays
+    ]
+
+    combined = da.map_blocks(
+        ensemble_block, *members,
+        statistics=[(s['statistic'], s.get('kwargs', {})) for s in statistics],
+        new_axis=0,
+        chunks=((len(statistics),),) + template.data.chunks,
+        dtype=np.float64,
+    )
+
+    return [
+        xr.DataArray(
+            combined[i], dims=template.dims, coords=template.coords,
+            name=s['name'], attrs=s.get('attrs', {}),
+        )
+        for i, s in enumerate(statistics)
+    ]
 
 
 @click.command()
+@profile_option
 @click.argument('projectionfiles', nargs=-1, type=click.Path(
     path_type=Path, exists=True
 ))
@@ -31,41 +133,30 @@ def main(projectionfiles, configfile, outputfile):
     statistics = config['statistics']
     chunks = config['chunks']
 
-    datasets = []
-    for pf in sorted(projectionfiles):
-        pname = os.path.splitext(os.path.basename(pf))[0]
-        ds = xr.open_zarr(pf)
-        ds = ds.assign_coords(coords={ 'projection': pname })
-        ds = ds.expand_dims(dim={ 'projection': 1 }, axis=0)
-        datasets.append(ds)
-
-    ds = xr.concat(
-        datasets, dim='projection', coords='different', data_vars='all'
-    )
+    start_execution(config)
 
-    stats = [
-        getattr(
-            ds[s['variable']], s['statistic']
-        )(
-            dim='projection', **s.get('kwargs', {})
-        ).rename(
-            s['name']
-        )
-        for s in statistics
+    datasets = [
+        xr.open_zarr(pf) for pf in sorted(projectionfiles)
     ]
-    for s, sinfo in zip(stats, statistics):
-        s.attrs.update(**sinfo.get('attrs', {}))
+    datasets = xr.align(*datasets, join='exact')
+
+    # Group statistics by variable so each variable is read only once
+    variables = list(dict.fromkeys(s['variable'] for s in statistics))
+    stats = []
+    for var in variables:
+        vstats = [s for s in statistics if s['variable'] == var]
+        stats += ensemble_statistics([ds[var] for ds in datasets], vstats)
 
     dataset = xr.merge(stats, join='exact', combine_attrs='drop')
 
-    dataset.rio.write_crs(ds.rio.crs, inplace=True)
+    dataset.rio.write_crs(datasets[0].rio.crs, inplace=True)
 
-    write_job = dataset.chunk(chunks).to_zarr(
+    write_job = dataset.chunk(resolve_chunks(dataset, chunks)).to_zarr(
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
+    write_series_copy(outputfile, chunks)
 
 
 if __name__ == '__main__':
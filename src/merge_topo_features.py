@@ -4,9 +4,11 @@ import click
 import xarray as xr
 import rioxarray as rxr
 from pathlib import Path
-from dask.diagnostics import ProgressBar
 
 from convert_bcm_v8 import load_config
+from regrid import regrid_like
+from execution import start_execution, run
+from profiling import profile_option
 
 
 def get_variable(ds, vinfo):
@@ -19,6 +21,7 @@ def get_variable(ds, vinfo):
 
 
 @click.command()
+@profile_option
 @click.argument('variablefiles', nargs=-1, type=click.Path(
     path_type=Path, exists=True
 ))
@@ -36,6 +39,10 @@ def main(variablefiles, bcmfile, configfile, outputfile):
     config = load_config(configfile)
     chunks = config['chunks']
     variables = config['variables']
+    method = config.get('resampling', 'nearest')
+    cache_dir = config.get('mapping_cache_dir', None)
+
+    start_execution(config)
 
     dataset = xr.open_mfdataset(
         variablefiles, join='override', parallel=True, engine='h5netcdf'
@@ -52,7 +59,11 @@ def main(variablefiles, bcmfile, configfile, outputfile):
     bcm_ds = bcm_ds.rename({ 'easting': 'x', 'northing': 'y' })
 
     converted.rio.write_crs(dataset.crs.proj4, inplace=True)
-    reproj = converted.rio.reproject_match(bcm_ds)
+    # The source to BCM grid mapping is computed once and cached
+    reproj = regrid_like(
+        converted, bcm_ds, method=method, cache_dir=cache_dir,
+        chunks=(chunks['northing'], chunks['easting'])
+    )
 
     reproj = reproj.rename({ 'x': 'easting', 'y': 'northing' })
     reproj = reproj.chunk(chunks)
@@ -61,8 +72,7 @@ def main(variablefiles, bcmfile, configfile, outputfile):
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
 
 
 if __name__ == '__main__':
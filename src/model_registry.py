@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+EcoPro Tree Mortality
+Model Registry
+
+A registered model is a directory with `metadata.json` (backend, features,
+training years, hyperparameters, a fingerprint of the training data, and
+bin edges) and the nodes of all of its trees as flat `.npy` arrays. The
+arrays are memory mapped on load, so all workers on a node share one page
+cached copy of the model and loading takes no time.
+"""
+import os
+import json
+import click
+import shutil
+import hashlib
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from skops.io import load
+
+from models import TRUSTED_TYPES
+from stage_cache import fingerprint_store
+from profiling import profile_option
+
+
+METADATA_FILE = 'metadata.json'
+
+TREE_ARRAYS = (
+    'feature', 'threshold', 'left', 'right', 'value', 'missing_left', 'roots'
+)
+
+# Number of samples passed through the trees at once
+PREDICT_BATCH = 2**16
+
+
+def concat_nodes(trees):
+    """
+    Concatenate per-tree node arrays (with child indices local to each
+    tree, -1 at leaves) into flat arrays indexed from the tree roots
+    """
+    offsets = np.cumsum([0] + [len(t['feature']) for t in trees])
+    arrays = {
+        k: np.concatenate([t[k] for t in trees])
+        for k in ('feature', 'threshold', 'value', 'missing_left')
+    }
+    for k in ('left', 'right'):
+        arrays[k] = np.concatenate([
+            np.where(t[k] >= 0, t[k] + o, -1) for t, o in zip(trees, offsets)
+        ])
+    arrays['roots'] = offsets[:-1]
+    return arrays
+
+
+def tree_arrays(model):
+    """
+    Node arrays of a random forest or gradient boosting model, and how
+    their leaf values are combined
+    """
+    if hasattr(model, 'estimators_'):
+        trees = []
+        for estimator in model.estimators_:
+            t = estimator.tree_
+            trees.append({
+                'feature': t.feature,
+                'threshold': t.threshold,
+                'value': t.value[:, 0, 0],
+                'missing_left': getattr(
+                    t, 'missing_go_to_left', np.zeros(t.node_count, np.uint8)
+                ),
+                'left': t.children_left,
+                'right': t.children_right,
+            })
+        # Trees compare features in float32
+        combine = { 'aggregate': 'mean', 'baseline': 0.0,
+            'input_dtype': 'float32' }
+    else:
+        trees = []
+        for predictors in model._predictors:
+            for predictor in predictors:
+                n = predictor.nodes
+                leaf = n['is_leaf'] == 1
+                trees.append({
+                    'feature': n['feature_idx'],
+                    'threshold': n['num_threshold'],
+                    'value': n['value'],
+                    'missing_left': n['missing_go_to_left'],
+                    'left': np.where(leaf, -1, n['left'].astype(np.int64)),
+                    'right': np.where(leaf, -1, n['right'].astype(np.int64)),
+                })
+        combine = {
+            'aggregate': 'sum',
+            'baseline': float(np.ravel(model._baseline_prediction)[0]),
+            'input_dtype': 'float64',
+        }
+
+    arrays = concat_nodes(trees)
+    arrays['feature'] = arrays['feature'].astype(np.int32)
+    arrays['missing_left'] = arrays['missing_left'].astype(np.uint8)
+    return arrays, combine
+
+
+def json_params(model):
+    return {
+        k: v for k, v in model.get_params().items()
+        if isinstance(v, (bool, int, float, str, type(None)))
+    }
+
+
+def data_fingerprint(trainingfile):
+    h = hashlib.sha1()
+    fingerprint_store(trainingfile, h)
+    return h.hexdigest()
+
+
+def save_model(modeldir, model, features, backend, bin_edges=None,
+        training_years=(), trainingfile=None):
+    """
+    Write a model to a registry directory, replacing it if it exists
+    """
+    arrays, combine = tree_arrays(model)
+    metadata = dict(combine, **{
+        'backend': backend,
+        'features': list(features),
+        'training_years': [int(y) for y in training_years],
+        'hyperparameters': json_params(model),
+        'training_data': None if trainingfile is None else {
+            'path': os.path.abspath(trainingfile),
+            'fingerprint': data_fingerprint(trainingfile),
+        },
+        'bin_edges': None if bin_edges is None else [
+            e.tolist() for e in bin_edges
+        ],
+        'n_trees': len(arrays['roots']),
+        'n_nodes': len(arrays['feature']),
+        'created': datetime.now().isoformat(),
+    })
+
+    tmp = f'{modeldir}.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name in TREE_ARRAYS:
+        np.save(os.path.join(tmp, f'{name}.npy'), arrays[name])
+    with open(os.path.join(tmp, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    if os.path.exists(modeldir):
+        shutil.rmtree(modeldir)
+    os.replace(tmp, modeldir)
+
+
+class RegisteredModel(object):
+    """
+    Predicts with the memory mapped trees of a registered model
+    """
+
+    def __init__(self, modeldir):
+        with open(os.path.join(modeldir, METADATA_FILE), 'r') as f:
+            self.metadata = json.load(f)
+        for name in TREE_ARRAYS:
+            setattr(self, name, np.asarray(np.load(
+                os.path.join(modeldir, f'{name}.npy'), mmap_mode='r'
+            )))
+
+    def leaf_values(self, X):
+        """
+        Leaf values reached by each sample in each tree (trees x samples)
+        """
+        n = len(X)
+        node = np.repeat(self.roots, n)
+        # Walk only the (tree, sample) pairs that are not at a leaf yet
+        active = np.flatnonzero(self.left[node] >= 0)
+        while len(active) > 0:
+            current = node[active]
+            x = X[active % n, self.feature[current]]
+            go_left = np.where(
+                np.isnan(x), self.missing_left[current] == 1,
+                x <= self.threshold[current]
+            )
+            node[active] = np.where(
+                go_left, self.left[current], self.right[current]
+            )
+            active = active[self.left[node[active]] >= 0]
+        return self.value[node].reshape((len(self.roots), n))
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=self.metadata['input_dtype'])
+        y = np.empty(len(X))
+        for start in range(0, len(X), PREDICT_BATCH):
+            values = self.leaf_values(X[start:start + PREDICT_BATCH])
+            if self.metadata['aggregate'] == 'mean':
+                y[start:start + PREDICT_BATCH] = values.mean(axis=0)
+            else:
+                y[start:start + PREDICT_BATCH] = (
+                    self.metadata['baseline'] + values.sum(axis=0)
+                )
+        return y
+
+
+def load_model_info(modelfile):
+    """
+    Load a registered model directory, or a skops model file, as a dict
+    with the model, its features, and its bin edges
+    """
+    if os.path.isdir(modelfile):
+        model = RegisteredModel(modelfile)
+        edges = model.metadata['bin_edges']
+        return {
+            'model': model,
+            'features': model.metadata['features'],
+            'backend': model.metadata['backend'],
+            'bin_edges': None if edges is None else [
+                np.asarray(e) for e in edges
+            ],
+        }
+
+    with open(modelfile, 'rb') as f:
+        return load(f, trusted=TRUSTED_TYPES)
+
+
+@click.command()
+@profile_option
+@click.argument('registrydir', type=click.Path(
+    path_type=Path, exists=True
+))
+def main(registrydir):
+    """
+    List the models in a registry directory
+    """
+    for metadatafile in sorted(registrydir.glob(f'*/{METADATA_FILE}')):
+        with open(metadatafile, 'r') as f:
+            m = json.load(f)
+        print(
+            f'{metadatafile.parent.name}: {m["backend"]}, {m["n_trees"]} trees, '
+            f'{len(m["features"])} features, years {m["training_years"]}, '
+            f'created {m["created"][:19]}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+EcoPro Tree Mortality
+Model Backends
+"""
+import numpy as np
+from sklearn.ensemble import (
+    RandomForestRegressor, HistGradientBoostingRegressor
+)
+
+
+# Estimator, default parameters, and whether features are quantized
+BACKENDS = {
+    'random_forest': (RandomForestRegressor, { 'max_depth': 5 }, False),
+    'hist_gradient_boosting': (HistGradientBoostingRegressor, {}, True),
+}
+
+DEFAULT_BACKEND = 'random_forest'
+
+# Maximum number of bins of quantized features; codes fit in uint8
+MAX_BINS = 255
+
+# Maximum size of a batch of stacked permuted feature matrices, in bytes
+PERMUTATION_BATCH_BYTES = 2**28
+
+# Model internals that skops does not trust by default (our model files
+# are written by save_rf_model)
+TRUSTED_TYPES = [
+    'sklearn.tree._tree.Tree',
+    'sklearn.ensemble._hist_gradient_boosting.predictor.TreePredictor',
+]
+
+
+def make_model(backend=DEFAULT_BACKEND, params=None):
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown model backend "{backend}"')
+    estimator, defaults, _ = BACKENDS[backend]
+    return estimator(**dict(defaults, **(params or {})))
+
+
+def quantizes(backend):
+    return BACKENDS[backend][2]
+
+
+def bin_edges(X, max_bins=MAX_BINS):
+    """
+    Per-feature bin edges: midpoints between distinct values if there are
+    at most `max_bins` of them, quantiles otherwise
+    """
+    edges = []
+    for column in X.T:
+        finite = column[np.isfinite(column)]
+        values = np.unique(finite)
+        if len(values) <= max_bins:
+            e = (values[:-1] + values[1:]) / 2
+        else:
+            q = np.linspace(0, 1, max_bins + 1)[1:-1]
+            e = np.unique(np.quantile(finite, q, method='midpoint'))
+        edges.append(e)
+    return edges
+
+
+def quantize(X, edges):
+    """
+    Map features to uint8 bin codes
+    """
+    codes = np.empty(X.shape, dtype=np.uint8)
+    for j, e in enumerate(edges):
+        codes[:, j] = np.searchsorted(e, X[:, j], side='right')
+    return codes
+
+
+def model_features(X, model_info):
+    """
+    Features as the model of a saved model file expects them
+    """
+    edges = model_info.get('bin_edges', None)
+    if edges is None:
+        return X
+    return quantize(X, edges)
+
+
+def feature_importances(model):
+    """
+    Impurity-based importances of a random forest, or the total split
+    gains of a gradient boosting model, normalized to sum to one
+    """
+    if hasattr(model, 'feature_importances_'):
+        return model.feature_importances_
+
+    gains = np.zeros(model.n_features_in_)
+    for predictors in model._predictors:
+        for predictor in predictors:
+            nodes = predictor.nodes[predictor.nodes['is_leaf'] == 0]
+            np.add.at(gains, nodes['feature_idx'], nodes['gain'])
+    total = gains.sum()
+    return gains / total if total > 0 else gains
+
+
+def permutation_importances(model, X, y, n_repeats=5, seed=None):
+    """
+    Mean increase of the model's mean squared error on (X, y) when a
+    feature is permuted, over `n_repeats` permutations per feature. The
+    permuted copies of X are stacked and predicted in batches.
+    """
+    rng = np.random.default_rng(seed)
+    n, n_features = X.shape
+    baseline = np.mean((model.predict(X) - y) ** 2)
+
+    permutations = [
+        (j, rng.permutation(n))
+        for j in range(n_features) for _ in range(n_repeats)
+    ]
+    per_batch = max(1, PERMUTATION_BATCH_BYTES // max(1, X.nbytes))
+
+    errors = np.zeros(n_features)
+    for start in range(0, len(permutations), per_batch):
+        batch = permutations[start:start + per_batch]
+        stacked = np.tile(X, (len(batch), 1))
+        for b, (j, perm) in enumerate(batch):
+            stacked[b * n:(b + 1) * n, j] = X[perm, j]
+        predictions = model.predict(stacked).reshape((len(batch), n))
+        for (j, _), error in zip(batch, np.mean((predictions - y) ** 2, axis=1)):
+            errors[j] += error
+
+    return errors / n_repeats - baseline
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import click
+import xarray as xr
+from pathlib import Path
+
+from util import load_config
+from execution import start_execution, run
+from append_folds import add_folds, open_folds
+from aggregate_bcm_v8 import aggregate_dataset
+from append_climate_indexes import climate_indexes
+from construct_training_dataset import training_dataset
+from grid_registry import load_grid
+from chunking import write_series_copy
+from precision import apply_precision, checked, save_report
+from convert_tree_mortality import convert_mortality
+from filter_zero_values import nonzero_samples
+from profiling import profile_option, phase
+
+
+def mortality_stage(config, datadir):
+    return convert_mortality(datadir, config)
+
+
+def folds_stage(config, ds):
+    return add_folds(ds, config)
+
+
+def training_stage(config, mort, clim, topo, grid=None):
+    return training_dataset(mort, clim, topo, config, grid)
+
+
+def nonzero_stage(config, ds):
+    return nonzero_samples(ds, config)
+
+
+def aggregate_stage(config, ds):
+    return aggregate_dataset(ds, config)
+
+
+def indexes_stage(config, ds, reference=None, grid=None):
+    return climate_indexes(ds, config, reference, grid)
+
+
+# Stage functions, and whether their inputs are paths rather than datasets
+STAGES = {
+    'mortality': (mortality_stage, True),
+    'folds': (folds_stage, False),
+    'training': (training_stage, False),
+    'nonzero': (nonzero_stage, False),
+    'aggregate': (aggregate_stage, False),
+    'climate_indexes': (indexes_stage, False),
+}
+
+
+def write_stage(dataset, config, outputfile):
+    """
+    Write a stage's output as its script does: cast to the config's
+    precision policy with a deviation report, and write a time-contiguous
+    copy if the output chunk plan asks for one
+    """
+    precision = config.get('precision', None)
+    dataset, deviations = apply_precision(dataset, precision)
+
+    write_job = dataset.to_zarr(
+        outputfile, mode='w', compute=False, consolidated=True
+    )
+    report = run(checked(write_job, deviations), 'write', [outputfile])
+    save_report(outputfile, report, precision)
+    write_series_copy(outputfile, config.get('output_chunks', None))
+
+
+def run_pipeline(stages, paths=None):
+    """
+    Run the stages in order. Each stage's result stays lazy and is fused
+    into the graph of the stages that use it, unless the stage has an
+    `output` (written to Zarr and reopened) or sets `persist`. Stages that
+    align datasets accept a registered `grid` file.
+    """
+    paths = paths or {}
+    results = {}
+
+    for stage in stages:
+        name = stage['name']
+        func, raw_inputs = STAGES[stage['stage']]
+        config = load_config(stage['config'].format(**paths))
+
+        inputs = []
+        for i in stage['inputs']:
+            if i in results:
+                inputs.append(results[i])
+            elif raw_inputs:
+                inputs.append(Path(i.format(**paths)))
+            else:
+                inputs.append(open_folds(i.format(**paths)))
+
+        kwargs = {}
+        if 'grid' in stage:
+            kwargs['grid'] = load_grid(stage['grid'].format(**paths))
+
+        print(f'Stage {name} ({stage["stage"]})...')
+        with phase(name):
+            dataset = func(config, *inputs, **kwargs)
+
+            if 'output' in stage:
+                outputfile = stage['output'].format(**paths)
+                write_stage(dataset, config, outputfile)
+                dataset = xr.open_zarr(outputfile)
+            elif stage.get('persist', False):
+                dataset = dataset.persist()
+
+        results[name] = dataset
+
+    return results
+
+
+@click.command()
+@profile_option
+@click.argument('pipelinefile', type=click.Path(
+    path_type=Path, exists=True
+))
+def main(pipelinefile):
+
+    config = load_config(pipelinefile)
+    start_execution(config)
+
+    run_pipeline(config['stages'], config.get('paths', {}))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,8 @@ from sklearn.metrics import (
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
+from profiling import profile_option
+
 PiYG = plt.get_cmap('PiYG')
 PiYG.set_bad(color=PiYG(0))
 
@@ -49,6 +51,7 @@ def get_matrices(years, metrics):
 
 
 @click.command()
+@profile_option
 @click.argument('resultfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -14,6 +14,8 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 from matplotlib.backends.backend_pdf import PdfPages
 
+from profiling import profile_option
+
 
 def get_parts(fname):
     match = re.match('([A-Z]+)([0-9])-([0-9])', fname)
@@ -46,6 +48,7 @@ def get_matrices(feature_names, importances):
 
 
 @click.command()
+@profile_option
 @click.argument('resultfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -53,11 +56,18 @@ def get_matrices(feature_names, importances):
     path_type=Path, exists=False
 ))
 @click.option('-y', '--year', type=int, default=None)
-def main(resultfile, outputfile, year):
+@click.option('-k', '--kind', default='importances',
+    type=click.Choice(['importances', 'permutation_importances']))
+def main(resultfile, outputfile, year, kind):
 
     metrics = defaultdict(dict)
     results = np.load(resultfile)
-    imp = results['importances']
+    imp = results[kind]
+    if kind == 'permutation_importances':
+        # Error increases as fractions of the total, like the impurity ones
+        imp = np.maximum(imp, 0)
+        total = imp.sum(axis=-1, keepdims=True)
+        imp = np.divide(imp, total, out=np.zeros_like(imp), where=total > 0)
     if year is None:
         importances = np.median(imp.reshape((-1, imp.shape[-1])), axis=0)
     else:
@@ -9,6 +9,8 @@ from collections import defaultdict
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
+from profiling import profile_option
+
 XLABELS = {
     'r2': 'R$^2$',
     'rmse': 'RMSE (trees / acre)',
@@ -47,6 +49,7 @@ def get_xlim(sname, xlim):
 
 
 @click.command()
+@profile_option
 @click.argument('resultfiles', nargs=-1, type=click.Path(
     path_type=Path, exists=True
 ))
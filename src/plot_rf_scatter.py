@@ -9,8 +9,11 @@ from collections import defaultdict
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
+from profiling import profile_option
+
 
 @click.command()
+@profile_option
 @click.argument('resultfile', type=click.Path(
     path_type=Path, exists=True
 ))
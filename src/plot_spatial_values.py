@@ -12,12 +12,15 @@ import cartopy.feature as cfeature
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
+from profiling import profile_option
+
 
 # Required for large high-res background image
 PIL.Image.MAX_IMAGE_PIXELS = 250000000
 
 
 @click.command()
+@profile_option
 @click.argument('datafile', type=click.Path(
     path_type=Path, exists=True
 ))
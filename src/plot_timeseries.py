@@ -13,10 +13,12 @@ import cartopy.feature as cfeature
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
-from convert_tree_mortality import apply_masks
+from convert_tree_mortality import apply_masks, read_shapefile
+from profiling import profile_option
 
 
 @click.command()
+@profile_option
 @click.argument('climatefile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -32,9 +34,13 @@ from convert_tree_mortality import apply_masks
 @click.argument('outputfile', type=click.Path(
     path_type=Path, exists=False
 ))
-def main(climatefile, histfile, projfile, shapefile, outputfile):
+@click.option('-g', '--geometry-cache', default=None,
+    type=click.Path(path_type=Path)
+)
+def main(climatefile, histfile, projfile, shapefile, outputfile,
+        geometry_cache):
 
-    shape_df = gpd.read_file(shapefile)
+    shape_df = read_shapefile(shapefile, cache_dir=geometry_cache)
 
     var = 'PR1'
     var = 'SPI1'
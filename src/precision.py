@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+EcoPro Tree Mortality
+Storage Precision
+
+A precision policy in a config is a dtype for all floating point data
+variables (`"float32"`), or a dict with a default `dtype`, `scale_factor`
+and `add_offset` for int16 packing, per-variable overrides (`variables`),
+and variables left as they are (`exclude`). Variables are computed at
+their own precision and only cast (or packed, clipped to the range int16
+packing represents) as they are written; the maximum deviation of the
+stored values from the computed ones is computed along with the write and
+saved next to the output.
+"""
+import json
+import click
+import dask
+import numpy as np
+import xarray as xr
+from pathlib import Path
+
+from profiling import profile_option
+
+
+PACKED_DTYPES = ('int16',)
+FLOAT_DTYPES = ('float32', 'float64')
+
+INT16_FILL = np.iinfo(np.int16).min
+INT16_MAX = np.iinfo(np.int16).max
+
+PACKING_ENCODING = ('dtype', 'scale_factor', 'add_offset', '_FillValue')
+
+REPORT_SUFFIX = '.precision.json'
+
+
+def variable_policy(spec, name):
+    """
+    The policy for one variable, or None to keep it as it is
+    """
+    if spec is None:
+        return None
+    if isinstance(spec, str):
+        return { 'dtype': spec }
+    if name in spec.get('exclude', ()):
+        return None
+    policy = {
+        k: v for k, v in spec.items() if k not in ('variables', 'exclude')
+    }
+    policy.update(spec.get('variables', {}).get(name, {}))
+    return policy if 'dtype' in policy else None
+
+
+def int16_range(scale_factor, add_offset):
+    """
+    The range of values that int16 packing can represent (the minimum is
+    left for the fill value)
+    """
+    return (
+        -INT16_MAX * scale_factor + add_offset,
+        INT16_MAX * scale_factor + add_offset,
+    )
+
+
+def stored_values(var):
+    """
+    The values of a variable as they are read back after it is written
+    with its encoding
+    """
+    encoded = xr.conventions.encode_cf_variable(var.variable, name=var.name)
+    return xr.conventions.decode_cf_variable(var.name, encoded)
+
+
+def apply_precision(ds, spec):
+    """
+    Cast the floating point data variables of a dataset according to a
+    policy. Returns the dataset and the (lazy) maximum absolute deviation
+    of each cast variable from its original values.
+    """
+    variables = {}
+    deviations = {}
+    for name, var in ds.data_vars.items():
+        policy = variable_policy(spec, name)
+        if policy is None or not np.issubdtype(var.dtype, np.floating):
+            continue
+
+        # Drop any packing the variable was read with
+        encoding = {
+            k: v for k, v in var.encoding.items() if k not in PACKING_ENCODING
+        }
+
+        dtype = policy['dtype']
+        if dtype in PACKED_DTYPES:
+            scale_factor = policy['scale_factor']
+            add_offset = policy.get('add_offset', 0.0)
+            # The encoder does not clip, and out of range values would
+            # wrap around
+            cast = var.clip(*int16_range(scale_factor, add_offset))
+            cast = cast.astype(np.float32)
+            encoding.update({
+                'dtype': dtype,
+                'scale_factor': scale_factor,
+                'add_offset': add_offset,
+                '_FillValue': INT16_FILL,
+            })
+        elif dtype in FLOAT_DTYPES:
+            cast = var.astype(dtype)
+        else:
+            raise ValueError(f'Unsupported precision "{dtype}" for {name}')
+
+        cast.encoding = encoding
+        variables[name] = cast
+        stored = stored_values(cast).astype(np.float64)
+        deviations[name] = abs(stored - var.variable).max()
+
+    return ds.assign(variables), deviations
+
+
+def checked(job, deviations):
+    """
+    Compute a write job together with the deviations of its variables
+    """
+    def report(_, deviations):
+        return { k: float(v) for k, v in deviations.items() }
+    return dask.delayed(report)(job, {
+        k: v.data for k, v in deviations.items()
+    })
+
+
+def report_file(outputfile):
+    outputfile = Path(outputfile)
+    return outputfile.with_name(outputfile.name + REPORT_SUFFIX)
+
+
+def save_report(outputfile, report, spec):
+    if not report:
+        return
+    for name, deviation in sorted(report.items()):
+        print(f'{name}: max deviation {deviation:.3g}')
+    with open(report_file(outputfile), 'w') as f:
+        json.dump({
+            'policy': spec, 'max_abs_deviation': report
+        }, f, indent=2)
+
+
+@click.command()
+@profile_option
+@click.argument('referencefile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('datasetfile', type=click.Path(
+    path_type=Path, exists=True
+))
+def main(referencefile, datasetfile):
+    """
+    Report the maximum deviation of a store from a reference store (e.g.,
+    a full-precision run)
+    """
+    ref = xr.open_zarr(referencefile)
+    ds = xr.open_zarr(datasetfile)
+    for name in sorted(set(ref.data_vars) & set(ds.data_vars)):
+        a, b = xr.align(ref[name], ds[name], join='inner')
+        deviation = float(abs(a.astype(np.float64) - b).max().compute())
+        print(f'{name}: {ref[name].dtype} -> {ds[name].dtype}, '
+              f'max deviation {deviation:.3g}')
+
+
+if __name__ == '__main__':
+    main()
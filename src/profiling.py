@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+EcoPro Tree Mortality
+Per-Phase Profiling
+
+Scripts record named phases with `phase` or `profiled`. When profiling is
+enabled (ECOPRO_PROFILE names a trace directory, or the `--profile` option
+of a script is given), each process writes the wall/CPU time, peak RSS, I/O
+and Dask task summaries of its phases to a JSON trace in a directory per
+run. Task summaries are kept for leaf phases only; the phase of the whole
+script records times and RSS. Child processes (e.g., Ray or Dask workers)
+inherit the run.
+"""
+import os
+import sys
+import json
+import time
+import click
+import atexit
+import socket
+import psutil
+import functools
+import threading
+import contextlib
+from glob import glob
+from datetime import datetime
+from collections import defaultdict
+from dask.utils import key_split
+from dask.callbacks import Callback
+from werkzeug.security import safe_join
+
+
+PROFILE_ENV = 'ECOPRO_PROFILE'
+RUN_ENV = 'ECOPRO_PROFILE_RUN'
+
+# Interval between RSS samples, in seconds
+SAMPLE_INTERVAL = 0.05
+
+# Number of task prefixes reported per phase
+TOP_TASKS = 10
+
+
+class Trace(object):
+    """
+    The phases recorded by this process, rewritten to its trace file
+    after each phase so that killed worker processes keep their records
+    """
+
+    def __init__(self, tracedir):
+        self.process = psutil.Process()
+        self.run = os.environ.setdefault(RUN_ENV, '{}_{}'.format(
+            os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python',
+            datetime.now().strftime('%Y%m%dT%H%M%S'),
+        ))
+        os.makedirs(safe_join(tracedir, self.run), exist_ok=True)
+        self.tracefile = safe_join(tracedir, self.run, f'{os.getpid()}.json')
+        self.header = {
+            'run': self.run,
+            'argv': sys.argv,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'started': datetime.now().isoformat(),
+        }
+        self.phases = []
+        self.active = []
+        self.parents = set()
+        self.lock = threading.Lock()
+        self.timer = TaskTimer(self)
+        self.timer.register()
+        sampler = threading.Thread(target=self.sample, daemon=True)
+        sampler.start()
+
+    def rss(self):
+        return self.process.memory_info().rss
+
+    def sample(self):
+        while True:
+            rss = self.rss()
+            with self.lock:
+                for record in self.active:
+                    record['peak_rss'] = max(record['peak_rss'], rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def io(self):
+        try:
+            c = self.process.io_counters()
+        except (AttributeError, psutil.Error):
+            return {}
+        return {
+            'read_bytes': getattr(c, 'read_chars', c.read_bytes),
+            'write_bytes': getattr(c, 'write_chars', c.write_bytes),
+        }
+
+    def cpu(self):
+        t = self.process.cpu_times()
+        return t.user + t.system + t.children_user + t.children_system
+
+    def write(self):
+        tmp = f'{self.tracefile}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(self.header, phases=self.phases), f, indent=2)
+        os.replace(tmp, self.tracefile)
+
+
+class TaskTimer(Callback):
+    """
+    Time the tasks of the local schedulers, keeping only the key prefix
+    and duration of each task for the innermost active phase
+    """
+
+    def __init__(self, trace):
+        super().__init__()
+        self.trace = trace
+        self.started = {}
+
+    def _pretask(self, key, dsk, state):
+        self.started[key] = time.perf_counter()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        seconds = time.perf_counter() - self.started.pop(key)
+        with self.trace.lock:
+            if self.trace.active and 'tasks' in self.trace.active[-1]:
+                self.trace.active[-1]['tasks'].append((key_split(key), seconds))
+
+
+_trace = None
+
+
+def get_trace():
+    """
+    The trace of this process, or None if profiling is disabled
+    """
+    global _trace
+    tracedir = os.environ.get(PROFILE_ENV, None)
+    if _trace is None and tracedir:
+        _trace = Trace(tracedir)
+    return _trace
+
+
+def store_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path) for name in files
+    )
+
+
+def summarize_tasks(durations):
+    """
+    Count and total duration of tasks by key prefix, longest first
+    """
+    summary = defaultdict(lambda: { 'tasks': 0, 'seconds': 0.0 })
+    for prefix, seconds in durations:
+        s = summary[prefix]
+        s['tasks'] += 1
+        s['seconds'] += seconds
+    ranked = sorted(summary.items(), key=lambda kv: -kv[1]['seconds'])
+    return dict(ranked[:TOP_TASKS])
+
+
+def scheduler_tasks(client, start):
+    """
+    (key prefix, duration) pairs of the tasks the distributed scheduler
+    computed since `start`
+    """
+    return [
+        (key_split(t['key']), s['stop'] - s['start'])
+        for t in client.get_task_stream(start=start)
+        for s in t['startstops'] if s['action'] == 'compute'
+    ]
+
+
+@contextlib.contextmanager
+def phase(name, reads=(), writes=(), tasks=True):
+    """
+    Record a named phase; `reads` and `writes` are the stores it uses.
+    With `tasks`, the Dask tasks computed in the phase are summarized if
+    it is a leaf phase.
+    """
+    trace = get_trace()
+    if trace is None:
+        yield
+        return
+
+    from execution import current_client
+
+    record = {
+        'name': name,
+        'parent': trace.active[-1]['name'] if trace.active else None,
+        'peak_rss': trace.rss(),
+    }
+    client = current_client() if tasks else None
+    if tasks:
+        record['tasks'] = []
+    if client is not None:
+        # Make sure the scheduler records its task stream
+        client.get_task_stream(count=0)
+    io = trace.io()
+    cpu = trace.cpu()
+    started = time.time()
+    start = time.perf_counter()
+    with trace.lock:
+        if trace.active:
+            trace.parents.add(id(trace.active[-1]))
+        trace.active.append(record)
+
+    try:
+        yield
+    finally:
+        record['wall'] = time.perf_counter() - start
+        record['cpu'] = trace.cpu() - cpu
+        record['io'] = { k: v - io[k] for k, v in trace.io().items() }
+        record['stores'] = {
+            'read': { str(p): store_size(p) for p in reads },
+            'write': {
+                str(p): store_size(p) for p in writes if os.path.exists(p)
+            },
+        }
+        with trace.lock:
+            trace.active.remove(record)
+            leaf = id(record) not in trace.parents
+            trace.parents.discard(id(record))
+        durations = record.pop('tasks', [])
+        if leaf and client is not None:
+            durations = scheduler_tasks(client, started)
+        record['tasks'] = summarize_tasks(durations) if leaf else {}
+        with trace.lock:
+            trace.phases.append(record)
+        trace.write()
+
+
+def profiled(name):
+    """
+    Record each call of the decorated function as a phase
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_profiling(ctx, param, tracedir):
+    """
+    Enable profiling for this process and its children and record the
+    whole script as a phase (without its tasks)
+    """
+    if not tracedir:
+        return
+    os.environ[PROFILE_ENV] = str(tracedir)
+    script = os.path.splitext(ctx.info_name or 'main')[0]
+    stack = contextlib.ExitStack()
+    stack.enter_context(phase(script, tasks=False))
+    atexit.register(stack.close)
+
+
+profile_option = click.option(
+    '--profile', type=click.Path(), envvar=PROFILE_ENV, default=None,
+    expose_value=False, is_eager=True, callback=start_profiling,
+    help=f'Write a phase trace to this directory (or set {PROFILE_ENV})',
+)
+
+
+def load_run(path):
+    """
+    Merge the traces of all processes of a run (a directory or a file)
+    """
+    files = [path] if os.path.isfile(path) else glob(safe_join(path, '*.json'))
+    phases = []
+    for tracefile in sorted(files):
+        with open(tracefile, 'r') as f:
+            phases.extend(json.load(f)['phases'])
+    return phases
+
+
+def summarize_run(phases):
+    summary = {}
+    for p in phases:
+        s = summary.setdefault(p['name'], {
+            'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0,
+            'read_bytes': 0, 'write_bytes': 0, 'written': 0,
+        })
+        s['calls'] += 1
+        s['wall'] += p['wall']
+        s['cpu'] += p['cpu']
+        s['peak_rss'] = max(s['peak_rss'], p['peak_rss'])
+        s['read_bytes'] += p['io'].get('read_bytes', 0)
+        s['write_bytes'] += p['io'].get('write_bytes', 0)
+        s['written'] += sum(p['stores']['write'].values())
+    return summary
+
+
+def mb(n):
+    return f'{n / 2**20:.0f}M'
+
+
+@click.command()
+@click.argument('runs', nargs=-1, required=True, type=click.Path(exists=True))
+def main(runs):
+    """
+    Report the phases of profiled runs; with several runs, compare their
+    wall times with the first
+    """
+    summaries = [summarize_run(load_run(r)) for r in runs]
+    names = list(dict.fromkeys(n for s in summaries for n in s))
+
+    for run, summary in zip(runs, summaries):
+        print(f'\n{run}')
+        print(
+            f'{"phase":24} {"calls":>6} {"wall":>9} {"cpu":>9} '
+            f'{"peak rss":>9} {"read":>8} {"written":>8}'
+        )
+        for name in names:
+            if name not in summary:
+                continue
+            s = summary[name]
+            print(
+                f'{name:24} {s["calls"]:>6} {s["wall"]:>8.1f}s '
+                f'{s["cpu"]:>8.1f}s {mb(s["peak_rss"]):>9} '
+                f'{mb(s["read_bytes"]):>8} '
+                f'{mb(max(s["write_bytes"], s["written"])):>8}'
+            )
+
+    if len(summaries) > 1:
+        print(f'\nWall time relative to {runs[0]}')
+        for name in names:
+            base = summaries[0].get(name, {}).get('wall', None)
+            ratios = [
+                '-' if base is None or name not in s or base == 0
+                else f'{s[name]["wall"] / base:.2f}x'
+                for s in summaries[1:]
+            ]
+            print(f'{name:24} ' + ' '.join(f'{r:>8}' for r in ratios))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,14 @@ import xarray as xr
 import rioxarray
 from pathlib import Path
 from tqdm import tqdm
-from dask.diagnostics import ProgressBar
+
+from append_folds import open_folds
+from execution import start_execution, run
+from profiling import profile_option
 
 
 @click.command()
+@profile_option
 @click.argument('resultfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -21,11 +25,13 @@ from dask.diagnostics import ProgressBar
 ))
 def main(resultfile, mortalityfile, outputfile):
 
+    start_execution()
+
     results = np.load(resultfile)
     r_years = results['years'].tolist()
     ids = results['ids']
     preds = results['predictions']
-    ds = xr.open_zarr(mortalityfile)
+    ds = open_folds(mortalityfile)
 
     I = np.array(ds['id'].values)
     print(I.shape)
@@ -52,8 +58,7 @@ def main(resultfile, mortalityfile, outputfile):
         outputfile, mode='w', compute=False, consolidated=True
     )
 
-    with ProgressBar():
-        write_job.persist()
+    run(write_job)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,196 @@
+"""
+EcoPro Tree Mortality
+Regridding onto a fixed target grid with a precomputed, cached mapping
+"""
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+import dask.array as da
+import rasterio.warp
+from werkzeug.security import safe_join
+
+
+METHODS = ('nearest', 'bilinear')
+
+
+def get_grid(ds):
+    """
+    Describe the grid of a dataset with `x`/`y` spatial dimensions as
+    (transform, crs, shape)
+    """
+    return (
+        ds.rio.transform(recalc=True), ds.rio.crs,
+        (int(ds.rio.height), int(ds.rio.width))
+    )
+
+
+def mapping_cache_file(cache_dir, src_grid, dst_grid, method):
+    if cache_dir is None:
+        return None
+    key = '|'.join(map(str, (
+        tuple(src_grid[0]), src_grid[1], src_grid[2],
+        tuple(dst_grid[0]), dst_grid[1], dst_grid[2], method,
+    )))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return safe_join(cache_dir, f'regrid_{digest}.npz')
+
+
+def compute_mapping(src_grid, dst_grid, method='nearest'):
+    """
+    For each target cell (in row-major order), find the flat indices of the
+    source cells it is interpolated from and their weights. Indices of -1
+    fall outside of the source grid.
+    """
+    if method not in METHODS:
+        raise ValueError(f'Unknown regridding method "{method}"')
+
+    src_transform, src_crs, (src_rows, src_cols) = src_grid
+    dst_transform, dst_crs, (dst_rows, dst_cols) = dst_grid
+
+    rows, cols = np.meshgrid(
+        np.arange(dst_rows), np.arange(dst_cols), indexing='ij'
+    )
+    xs, ys = dst_transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+    xs, ys = rasterio.warp.transform(dst_crs, src_crs, xs, ys)
+    fc, fr = ~src_transform * (np.asarray(xs), np.asarray(ys))
+
+    if method == 'nearest':
+        r = np.floor(fr).astype(int)[:, np.newaxis]
+        c = np.floor(fc).astype(int)[:, np.newaxis]
+        weights = np.ones(r.shape)
+    else:
+        # Interpolate between the four surrounding cell centers
+        fr = fr - 0.5
+        fc = fc - 0.5
+        r0 = np.floor(fr).astype(int)
+        c0 = np.floor(fc).astype(int)
+        wr = fr - r0
+        wc = fc - c0
+        r = np.stack([r0, r0, r0 + 1, r0 + 1], axis=1)
+        c = np.stack([c0, c0 + 1, c0, c0 + 1], axis=1)
+        weights = np.stack([
+            (1 - wr) * (1 - wc), (1 - wr) * wc, wr * (1 - wc), wr * wc
+        ], axis=1)
+
+    inside = (r >= 0) & (r < src_rows) & (c >= 0) & (c < src_cols)
+    indices = np.where(inside, r * src_cols + c, -1)
+    weights = np.where(inside, weights, 0.0)
+
+    return indices, weights
+
+
+def load_mapping(src_grid, dst_grid, method='nearest', cache_dir=None):
+    """
+    Load the source-to-target mapping from the cache, computing and storing
+    it if it does not exist yet
+    """
+    cache_file = mapping_cache_file(cache_dir, src_grid, dst_grid, method)
+    if cache_file is not None and os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return cached['indices'], cached['weights']
+
+    indices, weights = compute_mapping(src_grid, dst_grid, method)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{cache_file}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, indices=indices, weights=weights)
+        os.replace(tmp, cache_file)
+
+    return indices, weights
+
+
+def gather_block(block, indices, weights):
+    """
+    Interpolate one target block from the source window `block`, where
+    `indices` are flat indices into the last two axes of the window
+    """
+    flat = block.reshape(block.shape[:-2] + (-1,))
+    values = flat[..., np.maximum(indices, 0)]
+    valid = (indices >= 0) & np.isfinite(values)
+    w = np.where(valid, weights, 0.0)
+    total = w.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(valid, values, 0.0) * w
+        return np.where(total > 0, result.sum(axis=-1) / total, np.nan)
+
+
+def regrid(var, mapping, dst_shape, src_cols, chunks=(512, 512)):
+    """
+    Apply a mapping to a variable whose last two dimensions are the source
+    (y, x). Each target block only reads the source window it depends on.
+    """
+    indices, weights = mapping
+    k = indices.shape[-1]
+    indices = indices.reshape(dst_shape + (k,))
+    weights = weights.reshape(dst_shape + (k,))
+
+    data = var.data
+    if not isinstance(data, da.Array):
+        data = da.from_array(data)
+    dtype = np.result_type(data.dtype, np.float32)
+    lead_shape = data.shape[:-2]
+
+    row_starts = range(0, dst_shape[0], chunks[0])
+    col_starts = range(0, dst_shape[1], chunks[1])
+
+    blocks = []
+    for r in row_starts:
+        row_blocks = []
+        for c in col_starts:
+            idx = indices[r:r + chunks[0], c:c + chunks[1]]
+            w = weights[r:r + chunks[0], c:c + chunks[1]]
+            valid = idx >= 0
+            if not np.any(valid):
+                row_blocks.append(da.full(
+                    lead_shape + idx.shape[:2], np.nan, dtype=dtype
+                ))
+                continue
+
+            src_r, src_c = np.divmod(idx[valid], src_cols)
+            r0, r1 = src_r.min(), src_r.max() + 1
+            c0, c1 = src_c.min(), src_c.max() + 1
+            local = np.full(idx.shape, -1)
+            local[valid] = (src_r - r0) * (c1 - c0) + (src_c - c0)
+
+            window = data[..., r0:r1, c0:c1].rechunk({-2: -1, -1: -1})
+            row_blocks.append(da.map_blocks(
+                gather_block, window, indices=local, weights=w,
+                chunks=window.chunks[:-2] + ((idx.shape[0],), (idx.shape[1],)),
+                dtype=dtype,
+            ))
+        blocks.append(row_blocks)
+
+    return da.block(blocks)
+
+
+def regrid_like(ds, target, method='nearest', cache_dir=None,
+        chunks=(512, 512)):
+    """
+    Put all variables of `ds` onto the grid of `target`; both use `x`/`y`
+    spatial dimensions
+    """
+    src_grid = get_grid(ds)
+    dst_grid = get_grid(target)
+    mapping = load_mapping(src_grid, dst_grid, method, cache_dir)
+
+    variables = {}
+    for name, var in ds.data_vars.items():
+        if 'x' not in var.dims or 'y' not in var.dims:
+            continue
+        var = var.transpose(..., 'y', 'x')
+        data = regrid(var, mapping, dst_grid[2], src_grid[2][1], chunks)
+        variables[name] = (var.dims, data, var.attrs)
+
+    coords = {
+        k: v for k, v in ds.coords.items()
+        if 'x' not in v.dims and 'y' not in v.dims and k != 'spatial_ref'
+    }
+    coords.update({ 'y': target.y.values, 'x': target.x.values })
+
+    regridded = xr.Dataset(data_vars=variables, coords=coords, attrs=ds.attrs)
+    regridded = regridded.rio.write_crs(target.rio.crs)
+    regridded = regridded.rio.write_transform(dst_grid[0])
+    return regridded.rio.write_coordinate_system()
@@ -3,14 +3,19 @@ import click
 import numpy as np
 import xarray as xr
 from pathlib import Path
-from sklearn.ensemble import RandomForestRegressor
 from skops.io import dump
 
 
 from train_rf_model_ray import filter_inf
+from profiling import profile_option
+from models import (
+    BACKENDS, DEFAULT_BACKEND, make_model, quantizes, bin_edges, quantize
+)
+from model_registry import save_model
 
 
 @click.command()
+@profile_option
 @click.argument('trainingfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -18,7 +23,12 @@ from train_rf_model_ray import filter_inf
     path_type=Path, exists=False
 ))
 @click.option('-y', '--year', default=2012, type=int)
-def main(trainingfile, modelfile, year):
+@click.option('-m', '--model', 'backend', default=DEFAULT_BACKEND,
+    type=click.Choice(list(BACKENDS)), help='Model backend')
+@click.option('-f', '--format', 'model_format', default='skops',
+    type=click.Choice(['skops', 'registry']),
+    help='Write a skops file, or a registry directory with memory mappable trees')
+def main(trainingfile, modelfile, year, backend, model_format):
 
     ds = xr.open_zarr(trainingfile)
 
@@ -34,12 +44,27 @@ def main(trainingfile, modelfile, year):
     Xtrn = features.to_array().T
     Xtrn, ytrn = filter_inf(Xtrn, ytrn)
 
-    rf = RandomForestRegressor(max_depth=5)
-    rf.fit(Xtrn, ytrn)
+    # Quantized backends keep their bin edges to quantize inputs alike
+    edges = None
+    if quantizes(backend):
+        edges = bin_edges(Xtrn)
+        Xtrn = quantize(Xtrn, edges)
+
+    model = make_model(backend)
+    model.fit(Xtrn, ytrn)
+
+    if model_format == 'registry':
+        save_model(
+            modelfile, model, feature_names, backend, edges,
+            training_years=[year], trainingfile=trainingfile
+        )
+        return
 
     output = {
-        'model': rf,
+        'model': model,
         'features': feature_names,
+        'backend': backend,
+        'bin_edges': edges,
     }
 
     with open(modelfile, 'wb') as f:
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+import os
+import ast
+import sys
+import json
+import click
+import shutil
+import hashlib
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+from util import load_config
+from append_folds import OVERLAY_BASE_ATTR
+from chunking import series_store
+from precision import report_file
+
+
+# Default cache directory for commands run through the cache
+CACHE_ENV = 'ECOPRO_STAGE_CACHE'
+
+ENTRY_FILE = 'entry.json'
+OUTPUT_NAME = 'output'
+SIDE_OUTPUT_DIR = 'side'
+
+# Suffix of the file next to an output that records the key of the stage
+# run that produced it
+STAGE_KEY_SUFFIX = '.stage_key'
+
+# Files a stage writes next to its output
+SIDE_OUTPUTS = (report_file, series_store)
+
+CONFIG_SUFFIXES = ('.json', '.yml', '.yaml')
+
+SIZE_UNITS = { 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40 }
+
+
+def hash_file(path, h):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+
+
+def store_attrs(path):
+    for name in ('.zattrs', 'zarr.json'):
+        attrfile = os.path.join(path, name)
+        if os.path.exists(attrfile):
+            with open(attrfile, 'r') as f:
+                attrs = json.load(f)
+            return attrs.get('attributes', attrs) if name == 'zarr.json' else attrs
+    return {}
+
+
+def store_listing(path):
+    """
+    Digest of the names, sizes and modification times of the files of an
+    output, to tell if it changed since its stage key was recorded
+    """
+    h = hashlib.sha1()
+    if os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, files in os.walk(path) for name in files
+        )
+    for filename in paths:
+        st = os.stat(filename)
+        h.update(os.path.relpath(filename, path).encode('utf-8'))
+        h.update(f'{st.st_size} {st.st_mtime_ns}'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def stage_key_file(output):
+    output = Path(output)
+    return output.with_name(output.name + STAGE_KEY_SUFFIX)
+
+
+def write_stage_key(output, key):
+    keyfile = stage_key_file(output)
+    tmp = f'{keyfile}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({ 'key': key, 'listing': store_listing(output) }, f)
+    os.replace(tmp, keyfile)
+
+
+def recorded_key(path):
+    """
+    The key of the stage run that produced a path, if it was produced
+    through the cache and has not been modified since
+    """
+    keyfile = stage_key_file(path)
+    if not keyfile.exists():
+        return None
+    with open(keyfile, 'r') as f:
+        recorded = json.load(f)
+    if recorded['listing'] != store_listing(path):
+        return None
+    return recorded['key']
+
+
+def fingerprint_store(path, h):
+    """
+    Fingerprint a directory (e.g., a Zarr store) by the key of the stage
+    run that produced it or, without one, by the names and contents of all
+    of its files, following fold overlays to their base store
+    """
+    key = recorded_key(path)
+    if key is not None:
+        h.update(f'stage:{key}'.encode('utf-8'))
+    else:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                h.update(os.path.relpath(filename, path).encode('utf-8'))
+                hash_file(filename, h)
+
+    base = store_attrs(path).get(OVERLAY_BASE_ATTR, None)
+    if base is not None:
+        fingerprint_store(os.path.join(path, base), h)
+
+
+def local_modules(script, seen=None):
+    """
+    The script and the modules it imports from its own directory,
+    recursively
+    """
+    seen = set() if seen is None else seen
+    script = os.path.abspath(script)
+    if script in seen:
+        return seen
+    seen.add(script)
+
+    with open(script, 'r') as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [a.name for a in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = os.path.join(
+                os.path.dirname(script), name.split('.')[0] + '.py'
+            )
+            if os.path.exists(module):
+                local_modules(module, seen)
+
+    return seen
+
+
+def fingerprint(command, output):
+    """
+    Fingerprint a command by its code (scripts and their local imports),
+    parsed configs, and inputs (by the stage keys of cached outputs, or
+    their contents). Modification times are ignored, so touched or
+    re-downloaded identical files do not change the fingerprint.
+    """
+    h = hashlib.sha1()
+    output = os.path.abspath(output)
+    for arg in command:
+        h.update(b'\0')
+        if os.path.abspath(arg) == output:
+            h.update(b'{output}')
+        elif arg.endswith('.py') and os.path.isfile(arg):
+            for module in sorted(local_modules(arg)):
+                h.update(os.path.basename(module).encode('utf-8'))
+                hash_file(module, h)
+        elif arg.endswith(CONFIG_SUFFIXES) and os.path.isfile(arg):
+            config = json.dumps(load_config(arg), sort_keys=True, default=str)
+            h.update(config.encode('utf-8'))
+        elif os.path.isdir(arg):
+            fingerprint_store(arg, h)
+        elif os.path.isfile(arg):
+            hash_file(arg, h)
+        else:
+            h.update(arg.encode('utf-8'))
+    return h.hexdigest()
+
+
+def link_tree(src, dst):
+    """
+    Hard link a directory tree where possible. Single files are copied,
+    since they may be overwritten in place.
+    """
+    if os.path.isfile(src):
+        shutil.copy2(src, dst)
+        return
+
+    def link(s, d):
+        try:
+            os.link(s, d)
+        except OSError:
+            shutil.copy2(s, d)
+
+    shutil.copytree(src, dst, copy_function=link)
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path) for name in files
+    )
+
+
+def read_entry(entrydir):
+    with open(os.path.join(entrydir, ENTRY_FILE), 'r') as f:
+        return json.load(f)
+
+
+def write_entry(entrydir, entry):
+    entryfile = os.path.join(entrydir, ENTRY_FILE)
+    tmp = f'{entryfile}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(entry, f, indent=2)
+    os.replace(tmp, entryfile)
+
+
+def list_entries(cache_dir):
+    """
+    Complete cache entries as (key, entry) pairs, least recently used first
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for key in os.listdir(cache_dir):
+        entrydir = os.path.join(cache_dir, key)
+        if os.path.exists(os.path.join(entrydir, ENTRY_FILE)):
+            entries.append((key, read_entry(entrydir)))
+    return sorted(entries, key=lambda e: e[1]['last_used'])
+
+
+def side_outputs(output):
+    return [str(side(output)) for side in SIDE_OUTPUTS]
+
+
+def store_output(cache_dir, key, command, output):
+    entrydir = os.path.join(cache_dir, key)
+    tmp = f'{entrydir}.tmp'
+    remove_path(tmp)
+    os.makedirs(os.path.join(tmp, SIDE_OUTPUT_DIR))
+    link_tree(output, os.path.join(tmp, OUTPUT_NAME))
+
+    sides = [p for p in side_outputs(output) if os.path.exists(p)]
+    for side in sides:
+        link_tree(
+            side, os.path.join(tmp, SIDE_OUTPUT_DIR, os.path.basename(side))
+        )
+
+    now = datetime.now().isoformat()
+    write_entry(tmp, {
+        'command': list(command),
+        'output': os.path.abspath(output),
+        'side_outputs': [os.path.basename(p) for p in sides],
+        'size': path_size(output) + sum(path_size(p) for p in sides),
+        'created': now,
+        'last_used': now,
+    })
+    remove_path(entrydir)
+    os.replace(tmp, entrydir)
+
+
+def restore_output(cache_dir, key, output):
+    entrydir = os.path.join(cache_dir, key)
+    entry = read_entry(entrydir)
+
+    remove_path(output)
+    for side in side_outputs(output):
+        remove_path(side)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    # The output first: series copies count as current if they are newer
+    link_tree(os.path.join(entrydir, OUTPUT_NAME), output)
+    outdir = os.path.dirname(os.path.abspath(output))
+    for name in entry.get('side_outputs', []):
+        link_tree(
+            os.path.join(entrydir, SIDE_OUTPUT_DIR, name),
+            os.path.join(outdir, name)
+        )
+
+    entry['last_used'] = datetime.now().isoformat()
+    write_entry(entrydir, entry)
+
+
+def parse_size(size):
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.1f}T'
+
+
+def evict(cache_dir, budget):
+    """
+    Remove least recently used entries until the cache fits the budget
+    """
+    entries = list_entries(cache_dir)
+    total = sum(e['size'] for _, e in entries)
+    evicted = []
+    for key, entry in entries:
+        if total <= budget:
+            break
+        remove_path(os.path.join(cache_dir, key))
+        total -= entry['size']
+        evicted.append(key)
+    return evicted
+
+
+@click.group()
+def main():
+    """
+    Skip pipeline stages whose code, configs and inputs are unchanged
+    """
+
+
+@main.command(context_settings={ 'ignore_unknown_options': True })
+@click.option('-d', '--cache-dir', envvar=CACHE_ENV, required=True,
+    type=click.Path(path_type=Path))
+@click.option('-o', '--output', required=True, type=click.Path(path_type=Path),
+    help='Output file or directory of the command')
+@click.option('-b', '--budget', default=None,
+    help='Evict entries after storing the output to fit this size (e.g., 500G)')
+@click.argument('command', nargs=-1, required=True, type=click.UNPROCESSED)
+def run(cache_dir, output, budget, command):
+    """
+    Run a stage command, or link in its output from an earlier run with the
+    same fingerprint
+    """
+    key = fingerprint(command, output)
+    if os.path.exists(os.path.join(cache_dir, key, ENTRY_FILE)):
+        print(f'Cache hit {key[:12]}, linking {output}')
+        restore_output(cache_dir, key, output)
+        write_stage_key(output, key)
+        return
+
+    print(f'Cache miss {key[:12]}, running {" ".join(command)}')
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        sys.exit(result.returncode)
+    if not os.path.exists(output):
+        raise click.ClickException(f'Command did not create {output}')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    store_output(cache_dir, key, command, output)
+    write_stage_key(output, key)
+    if budget is not None:
+        evict(cache_dir, parse_size(budget))
+
+
+@main.command('list')
+@click.option('-d', '--cache-dir', envvar=CACHE_ENV, required=True,
+    type=click.Path(path_type=Path))
+def list_command(cache_dir):
+    """
+    List cache entries, least recently used first
+    """
+    entries = list_entries(cache_dir)
+    for key, entry in entries:
+        print(
+            f'{key[:12]}  {format_size(entry["size"]):>7}  '
+            f'{entry["last_used"][:19]}  {entry["output"]}'
+        )
+    total = sum(e['size'] for _, e in entries)
+    print(f'{len(entries)} entries, {format_size(total)}')
+
+
+@main.command('evict')
+@click.option('-d', '--cache-dir', envvar=CACHE_ENV, required=True,
+    type=click.Path(path_type=Path))
+@click.option('-b', '--budget', default='0',
+    help='Size to fit the cache in (e.g., 500G); evicts everything by default')
+@click.option('-k', '--key', 'keys', multiple=True,
+    help='Evict the entries with these (prefixes of) keys instead')
+def evict_command(cache_dir, budget, keys):
+    """
+    Evict least recently used cache entries
+    """
+    if keys:
+        evicted = [
+            k for k, _ in list_entries(cache_dir)
+            if any(k.startswith(p) for p in keys)
+        ]
+        for k in evicted:
+            remove_path(os.path.join(cache_dir, k))
+    else:
+        evicted = evict(cache_dir, parse_size(budget))
+
+    for k in evicted:
+        print(f'Evicted {k[:12]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+import click
+import warnings
+import numpy as np
+import xarray as xr
+import rioxarray
+import rasterio
+from rasterio.windows import Window
+from tqdm import tqdm
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from util import load_config
+from regrid import get_grid, load_mapping
+from execution import start_execution, run
+from profiling import profile_option
+
+
+METRICS = (
+    'elevation', 'slope', 'eastness', 'northness', 'tpi',
+    'vrm', 'rie', 'sapa', 'sdmv', 'adjsd',
+)
+
+
+def shift(a, dr, dc):
+    """
+    Return b with b[i, j] = a[i + dr, j + dc], NaN outside of `a`
+    """
+    rows, cols = a.shape
+    b = np.full(a.shape, np.nan)
+    b[
+        max(-dr, 0):rows - max(dr, 0),
+        max(-dc, 0):cols - max(dc, 0),
+    ] = a[
+        max(dr, 0):rows - max(-dr, 0),
+        max(dc, 0):cols - max(-dc, 0),
+    ]
+    return b
+
+
+def window_sum(a, h):
+    """
+    Sum of `a` over a (2h + 1) x (2h + 1) window, truncated at the array
+    edges, using an integral image
+    """
+    rows, cols = a.shape
+    ii = np.zeros((rows + 1, cols + 1))
+    ii[1:, 1:] = a.cumsum(axis=0).cumsum(axis=1)
+
+    r_lo = np.clip(np.arange(rows) - h, 0, rows)
+    r_hi = np.clip(np.arange(rows) + h + 1, 0, rows)
+    c_lo = np.clip(np.arange(cols) - h, 0, cols)
+    c_hi = np.clip(np.arange(cols) + h + 1, 0, cols)
+
+    return (
+        ii[np.ix_(r_hi, c_hi)] - ii[np.ix_(r_lo, c_hi)]
+        - ii[np.ix_(r_hi, c_lo)] + ii[np.ix_(r_lo, c_lo)]
+    )
+
+
+def window_moments(a, h, valid=None):
+    """
+    Count, sum, and sum of squares of the valid values of `a` in each window
+    """
+    if valid is None:
+        valid = np.isfinite(a)
+    values = np.where(valid, a, 0.0)
+    return (
+        window_sum(valid.astype(float), h),
+        window_sum(values, h),
+        window_sum(values**2, h),
+    )
+
+
+def sample_sd(n, s, ss):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (ss - s**2 / n) / (n - 1)
+    return np.where(n > 1, np.sqrt(np.maximum(var, 0.0)), np.nan)
+
+
+def gradient(z, scale, dx, dy):
+    """
+    Horn (queen) gradient using the cells `scale` cells away from the focal
+    cell; y is positive towards the north
+    """
+    s = scale
+    dzdx = (
+        (shift(z, -s, s) + 2 * shift(z, 0, s) + shift(z, s, s))
+        - (shift(z, -s, -s) + 2 * shift(z, 0, -s) + shift(z, s, -s))
+    ) / (8 * s * dx)
+    dzdy = (
+        (shift(z, -s, -s) + 2 * shift(z, -s, 0) + shift(z, -s, s))
+        - (shift(z, s, -s) + 2 * shift(z, s, 0) + shift(z, s, s))
+    ) / (8 * s * dy)
+    return dzdx, dzdy
+
+
+def plane_gradient(z, scale, dx, dy):
+    """
+    Gradient of the plane fitted (weighted least squares) to the valid
+    cells of the Horn stencil `scale` cells away from the focal cell,
+    which is the Horn gradient when all of them are valid. Missing cells
+    (nodata or outside of `z`) are skipped, as with na.rm in MultiscaleDTM.
+    """
+    s = scale
+    sums = { k: np.zeros(z.shape) for k in
+             ('w', 'x', 'y', 'z', 'xx', 'yy', 'xy', 'xz', 'yz') }
+    for dr in (-s, 0, s):
+        for dc in (-s, 0, s):
+            if dr == dc == 0:
+                continue
+            v = shift(z, dr, dc)
+            valid = np.isfinite(v)
+            w = np.where(valid, 2.0 if dr == 0 or dc == 0 else 1.0, 0.0)
+            v = np.where(valid, v, 0.0)
+            x, y = dc * dx, -dr * dy
+            sums['w'] += w
+            sums['x'] += w * x
+            sums['y'] += w * y
+            sums['z'] += w * v
+            sums['xx'] += w * x * x
+            sums['yy'] += w * y * y
+            sums['xy'] += w * x * y
+            sums['xz'] += w * x * v
+            sums['yz'] += w * y * v
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = sums['w']
+        cxx = sums['xx'] - sums['x']**2 / n
+        cyy = sums['yy'] - sums['y']**2 / n
+        cxy = sums['xy'] - sums['x'] * sums['y'] / n
+        cxz = sums['xz'] - sums['x'] * sums['z'] / n
+        cyz = sums['yz'] - sums['y'] * sums['z'] / n
+        det = cxx * cyy - cxy**2
+        # Valid cells on a line do not define a plane
+        defined = (n > 0) & (det > 1e-9 * cxx * cyy) & np.isfinite(z)
+        dzdx = np.where(defined, (cyy * cxz - cxy * cyz) / det, np.nan)
+        dzdy = np.where(defined, (cxx * cyz - cxy * cxz) / det, np.nan)
+    return dzdx, dzdy
+
+
+def slope_aspect(z, h, dx, dy):
+    dzdx, dzdy = plane_gradient(z, h, dx, dy)
+    g = np.hypot(dzdx, dzdy)
+    slope = np.degrees(np.arctan(g))
+    # Aspect faces downslope; flat cells have no aspect, and cells without
+    # a gradient (too few valid neighbors) stay NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eastness = np.where(g == 0, 0.0, -dzdx / g)
+        northness = np.where(g == 0, 0.0, -dzdy / g)
+    return slope, eastness, northness
+
+
+def tpi(z, h):
+    """
+    Difference between each cell and the mean of its neighbors
+    """
+    n, s, _ = window_moments(z, h)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 1, z - (s - z) / (n - 1), np.nan)
+
+
+def vrm(z, h, dx, dy):
+    """
+    Vector ruggedness measure (Sappington et al., 2007) from the unit
+    normals of the local (3x3) surface
+    """
+    dzdx, dzdy = gradient(z, 1, dx, dy)
+    norm = np.sqrt(1 + dzdx**2 + dzdy**2)
+    valid = np.isfinite(norm)
+    n = window_sum(valid.astype(float), h)
+    resultant = np.zeros(z.shape)
+    for component in (-dzdx / norm, -dzdy / norm, 1 / norm):
+        resultant += window_sum(np.where(valid, component, 0.0), h)**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 0, 1 - np.sqrt(resultant) / n, np.nan)
+
+
+def rie(z, h):
+    """
+    Roughness index-elevation (Cavalli et al., 2008): standard deviation of
+    the residual topography after removing the window mean
+    """
+    n, s, _ = window_moments(z, h)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residual = z - s / n
+    return sample_sd(*window_moments(residual, h))
+
+
+def sapa(z, h, dx, dy, slope):
+    """
+    Surface area to planar area ratio (Jenness, 2004), using the local
+    gradient for the surface area of each cell and correcting the planar
+    area for the slope of the window
+    """
+    dzdx, dzdy = gradient(z, 1, dx, dy)
+    n, s, _ = window_moments(np.sqrt(1 + dzdx**2 + dzdy**2), h)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 0, s / n, np.nan) * np.cos(np.radians(slope))
+
+
+def sdmv(z, radius):
+    """
+    Difference from the mean value over a circular window of `radius`
+    cells, standardized by the range of the window (Lecours et al., 2017);
+    MultiscaleDTM's DMV takes the radius as `w` for circular windows
+    """
+    offsets = [
+        (dr, dc)
+        for dr in range(-radius, radius + 1)
+        for dc in range(-radius, radius + 1)
+        if dr**2 + dc**2 <= radius**2
+    ]
+    n = np.zeros(z.shape)
+    s = np.zeros(z.shape)
+    vmin = np.full(z.shape, np.nan)
+    vmax = np.full(z.shape, np.nan)
+    for dr, dc in offsets:
+        v = shift(z, dr, dc)
+        valid = np.isfinite(v)
+        n += valid
+        s += np.where(valid, v, 0.0)
+        vmin = np.fmin(vmin, v)
+        vmax = np.fmax(vmax, v)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(vmax > vmin, (z - s / n) / (vmax - vmin), np.nan)
+
+
+def adjsd(z, h, dx, dy):
+    """
+    Adjusted standard deviation (Ilich et al., 2023): standard deviation of
+    the residuals from a plane fitted to each window, measured
+    perpendicular to the plane
+    """
+    rows, cols = z.shape
+    y, x = np.meshgrid(
+        (rows / 2 - np.arange(rows)) * dy,
+        (np.arange(cols) - cols / 2) * dx,
+        indexing='ij'
+    )
+    valid = np.isfinite(z)
+    zc = np.where(valid, z - np.nanmean(z), 0.0)
+    x = np.where(valid, x, 0.0)
+    y = np.where(valid, y, 0.0)
+
+    n = window_sum(valid.astype(float), h)
+    sx, sy, sz = (window_sum(v, h) for v in (x, y, zc))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cxx = window_sum(x * x, h) - sx * sx / n
+        cyy = window_sum(y * y, h) - sy * sy / n
+        cxy = window_sum(x * y, h) - sx * sy / n
+        cxz = window_sum(x * zc, h) - sx * sz / n
+        cyz = window_sum(y * zc, h) - sy * sz / n
+        czz = window_sum(zc * zc, h) - sz * sz / n
+
+        det = cxx * cyy - cxy**2
+        a = (cyy * cxz - cxy * cyz) / det
+        b = (cxx * cyz - cxy * cxz) / det
+        rss = np.maximum(czz - a * cxz - b * cyz, 0.0)
+        sd = np.sqrt(rss / (n - 3))
+
+    return np.where(n > 3, sd / np.sqrt(1 + a**2 + b**2), np.nan)
+
+
+def compute_metrics(z, window, dx, dy, metrics):
+    """
+    Compute the requested metrics for a DEM array using a window x window
+    neighborhood (a circle of radius `window` for SDMV)
+    """
+    h = window // 2
+    results = {}
+
+    if 'elevation' in metrics:
+        results['elevation'] = z
+
+    slope = None
+    if any(m in metrics for m in ('slope', 'eastness', 'northness', 'sapa')):
+        slope, eastness, northness = slope_aspect(z, h, dx, dy)
+        results.update(slope=slope, eastness=eastness, northness=northness)
+
+    if 'tpi' in metrics:
+        results['tpi'] = tpi(z, h)
+    if 'vrm' in metrics:
+        results['vrm'] = vrm(z, h, dx, dy)
+    if 'rie' in metrics:
+        results['rie'] = rie(z, h)
+    if 'sapa' in metrics:
+        results['sapa'] = sapa(z, h, dx, dy, slope)
+    if 'sdmv' in metrics:
+        results['sdmv'] = sdmv(z, window)
+    if 'adjsd' in metrics:
+        results['adjsd'] = adjsd(z, h, dx, dy)
+
+    nodata = np.isnan(z)
+    return {
+        m: np.where(nodata, np.nan, results[m]).astype(np.float32)
+        for m in metrics
+    }
+
+
+def process_tile(demfile, core, halo, window, metrics, rows, cols):
+    """
+    Compute the metrics on one core tile of the DEM, read with a halo of
+    `halo` cells so the window statistics do not depend on the tiling, and
+    return their values at the given (row, col) DEM cells within the core
+    """
+    row_off, col_off, height, width = core
+    with rasterio.open(demfile) as src:
+        r0 = max(row_off - halo, 0)
+        c0 = max(col_off - halo, 0)
+        r1 = min(row_off + height + halo, src.height)
+        c1 = min(col_off + width + halo, src.width)
+        z = src.read(
+            1, window=Window(c0, r0, c1 - c0, r1 - r0), masked=True
+        ).astype(np.float64).filled(np.nan)
+        dx, dy = abs(src.transform.a), abs(src.transform.e)
+
+    results = compute_metrics(z, window, dx, dy, metrics)
+    return {
+        m: values[rows - r0, cols - c0]
+        for m, values in results.items()
+    }
+
+
+@click.command()
+@profile_option
+@click.argument('demfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('bcmfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('configfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('outputfile', type=click.Path(
+    path_type=Path, exists=False
+))
+def main(demfile, bcmfile, configfile, outputfile):
+
+    warnings.filterwarnings('ignore', r'Mean of empty slice')
+
+    config = load_config(configfile)
+    window = config.get('window', 9)
+    tile_size = config.get('tile_size', 1024)
+    workers = config.get('workers', None)
+    cache_dir = config.get('mapping_cache_dir', None)
+    chunks = config['chunks']
+    variables = config['variables']
+
+    metrics = [v['name'] for v in variables]
+    unknown = [m for m in metrics if m not in METRICS]
+    if len(unknown) > 0:
+        raise ValueError(f'Unknown topographic indexes: {", ".join(unknown)}')
+
+    # Large enough for a window statistic of a window statistic (RIE), of a
+    # local gradient (VRM, SAPA), and for the circular SDMV window
+    halo = max(2 * (window // 2) + 1, window)
+
+    start_execution(config)
+
+    bcm_ds = xr.open_zarr(bcmfile)
+    bcm_ds = bcm_ds.rename({ 'easting': 'x', 'northing': 'y' })
+    dst_grid = get_grid(bcm_ds)
+    dst_shape = dst_grid[2]
+
+    # Each BCM cell takes the values of the DEM cell containing its center
+    with rasterio.open(demfile) as src:
+        src_shape = src.shape
+        src_grid = (src.transform, src.crs, src_shape)
+    indices, _ = load_mapping(src_grid, dst_grid, 'nearest', cache_dir)
+    src_rows, src_cols = np.divmod(indices[:, 0], src_shape[1])
+
+    # Group the BCM cells by the DEM tile they sample from
+    n_tile_cols = -(-src_shape[1] // tile_size)
+    inside = np.flatnonzero(indices[:, 0] >= 0)
+    tile_ids = (
+        (src_rows[inside] // tile_size) * n_tile_cols
+        + src_cols[inside] // tile_size
+    )
+    order = np.argsort(tile_ids, kind='stable')
+    tile_values, starts = np.unique(tile_ids[order], return_index=True)
+    groups = np.split(inside[order], starts[1:])
+
+    output = {
+        m: np.full(dst_shape[0] * dst_shape[1], np.nan, dtype=np.float32)
+        for m in metrics
+    }
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for tile, cells in zip(tile_values, groups):
+            row_off = (tile // n_tile_cols) * tile_size
+            col_off = (tile % n_tile_cols) * tile_size
+            core = (
+                row_off, col_off,
+                min(tile_size, src_shape[0] - row_off),
+                min(tile_size, src_shape[1] - col_off),
+            )
+            future = executor.submit(
+                process_tile, demfile, core, halo, window, metrics,
+                src_rows[cells], src_cols[cells],
+            )
+            futures[future] = cells
+
+        for future in tqdm(as_completed(futures), 'Topographic Indexes',
+                total=len(futures)):
+            cells = futures[future]
+            for m, values in future.result().items():
+                output[m][cells] = values
+
+    dataset = xr.Dataset(
+        data_vars={
+            v['name']: (
+                ('y', 'x'),
+                output[v['name']].reshape(dst_shape),
+                v.get('attrs', {}),
+            )
+            for v in variables
+        },
+        coords={
+            'y': bcm_ds.y,
+            'x': bcm_ds.x,
+        }
+    )
+    dataset.rio.write_crs(bcm_ds.rio.crs, inplace=True)
+    dataset = dataset.rename({ 'x': 'easting', 'y': 'northing' })
+
+    write_job = dataset.chunk(chunks).to_zarr(
+        outputfile, mode='w', compute=False, consolidated=True
+    )
+
+    run(write_job)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,17 @@ import xarray as xr
 from tqdm import tqdm
 from pathlib import Path
 from itertools import product
-from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_squared_error as mse, r2_score
 import logging
 import os
 
+from append_folds import make_fold_index, fold_members
+from profiling import profile_option, profiled
+from models import (
+    BACKENDS, DEFAULT_BACKEND, make_model, quantizes, bin_edges, quantize,
+    feature_importances, permutation_importances
+)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -25,40 +31,49 @@ def filter_inf(X, y=None, fill=1e2):
         raise ValueError('NaN entries present in target vector y')
     return Xnew, y
 
+NON_FEATURES = ('id', 'fold', 'easting', 'northing', 'year', 'tpa')
+
 def handle_nan(ds):
     # Handle NaN values by filling or removing them
     ds = ds.fillna(0)  # Example: fill NaNs with 0, you may choose a different strategy
     return ds
 
-@ray.remote
-def eval_fold(trainingfile, held_out_fold, training_year):
-    ds = xr.open_zarr(trainingfile)
-    ds = handle_nan(ds)  # Ensure NaN values are handled
-
-    idx = ((ds['year'] == training_year) & (ds['fold'] != held_out_fold)).compute()
-    ds_trn = ds.where(idx, drop=True).compute()
-
-    ytrn = ds_trn['tpa'].values
-    features = ds_trn.drop_vars(('id', 'fold', 'easting', 'northing', 'year', 'tpa'))
+def feature_matrix(ds):
+    features = ds.drop_vars(NON_FEATURES)
     feature_names = list(features.keys())
-    Xtrn = features.to_array().values.T
-    Xtrn, ytrn = filter_inf(Xtrn, ytrn)
+    X = features.to_array().values.T
+    return feature_names, X
+
+def sorted_block(values, value, offset=0):
+    # Bounds of the entries equal to `value` in sorted `values`
+    return (
+        offset + np.searchsorted(values, value, 'left'),
+        offset + np.searchsorted(values, value, 'right'),
+    )
 
-    rf = RandomForestRegressor(max_depth=5)
-    rf.fit(Xtrn, ytrn)
+@ray.remote
+@profiled('eval_fold')
+def eval_fold(X, y, ids, years, feature_names, backend, n_repeats,
+        held_out_fold, training_year, train_rows, test_rows):
+    # X and y are shared by all folds through the object store
+    model = make_model(backend)
+    model.fit(X[train_rows], y[train_rows])
 
-    importances = dict(zip(feature_names, rf.feature_importances_))
+    importances = dict(zip(feature_names, feature_importances(model)))
 
-    idx = (ds['fold'] == held_out_fold).compute()
-    ds_tst = ds.where(idx, drop=True).compute()
+    ids_tst = ids[test_rows]
+    years_tst = years[test_rows]
+    ytst = y[test_rows]
 
-    ids_tst = ds_tst['id'].values
-    years_tst = ds_tst['year'].values
-    ytst = ds_tst['tpa'].values
-    Xtst = ds_tst.drop_vars(('id', 'fold', 'easting', 'northing', 'year', 'tpa')).to_array().values.T
-    Xtst, ytst = filter_inf(Xtst, ytst)
+    ypred = model.predict(X[test_rows])
 
-    ypred = rf.predict(Xtst)
+    # Permute the held-out features of the fold's model
+    permuted = None
+    if n_repeats > 0:
+        permuted = dict(zip(feature_names, permutation_importances(
+            model, X[test_rows], ytst, n_repeats,
+            seed=(int(training_year), int(held_out_fold)),
+        )))
 
     year_unq = np.unique(years_tst)
     id_unq = np.unique(ids_tst)
@@ -79,23 +94,65 @@ def eval_fold(trainingfile, held_out_fold, training_year):
         'predictions': predictions,
         'targets': targets,
         'importances': importances,
+        'permutation_importances': permuted,
     }
 
 @click.command()
+@profile_option
 @click.argument('trainingfile', type=click.Path(path_type=Path, exists=True))
 @click.argument('resultfile', type=click.Path(path_type=Path, exists=False))
-def main(trainingfile, resultfile):
+@click.option('-m', '--model', 'backend', default=DEFAULT_BACKEND,
+    type=click.Choice(list(BACKENDS)), help='Model backend')
+@click.option('-p', '--permutation-repeats', 'n_repeats', default=5, type=int,
+    help='Permutations per feature for held-out permutation importances (0 to skip)')
+def main(trainingfile, resultfile, backend, n_repeats):
     os.environ["RAY_DISABLE_DASHBOARD"] = "1"  # Disable the Ray dashboard
     ray.init(ignore_reinit_error=True)
 
-    ds = xr.open_zarr(trainingfile)
+    ds = handle_nan(xr.open_zarr(trainingfile).compute())
     years = np.unique(ds['year'].values).astype(int)
     folds = np.unique(ds['fold'].values).astype(int)
     ids = np.unique(ds['id'].values).astype(int)
 
+    # Index samples by fold once, so each task gets its rows directly
+    sample_folds = ds['fold'].values
+    sample_years = ds['year'].values
+    fold_rows = make_fold_index(sample_folds, np.arange(len(sample_folds)))
+
+    # With the rows ordered by year, then fold, the training rows of a
+    # (year, fold) task are the rows of the year before and after the
+    # contiguous block of the fold
+    year_fold_rows = np.lexsort((sample_folds, sample_years))
+    sorted_years = sample_years[year_fold_rows]
+    sorted_folds = sample_folds[year_fold_rows]
+
+    # Prepare the features once for all folds; quantized backends get
+    # uint8 bin codes, and the forest the float32 it trains on
+    feature_names, X = feature_matrix(ds)
+    X, y = filter_inf(X, ds['tpa'].values)
+    if quantizes(backend):
+        X = quantize(X, bin_edges(X))
+    else:
+        X = X.astype(np.float32)
+
+    shared = [
+        ray.put(a) for a in (X, y, ds['id'].values, sample_years)
+    ]
+
     tasks = []
     for year, fold in product(years, folds):
-        task = eval_fold.remote(trainingfile, fold, year)
+        test_rows = fold_members(fold_rows, fold)
+        start, stop = sorted_block(sorted_years, year)
+        fold_start, fold_stop = sorted_block(
+            sorted_folds[start:stop], fold, start
+        )
+        train_rows = np.concatenate([
+            year_fold_rows[start:fold_start], year_fold_rows[fold_stop:stop]
+        ])
+        task = eval_fold.remote(
+            *shared, feature_names, backend, n_repeats,
+            fold, year, train_rows, test_rows
+        )
         tasks.append(task)
 
     results = ray.get(tasks)
@@ -105,6 +162,7 @@ def main(trainingfile, resultfile):
     predictions = np.zeros((len(years), len(years), len(ids)))
     targets = np.zeros((len(years), len(years), len(ids)))
     importances = np.zeros((len(years), len(folds), len(feature_names)))
+    permuted = np.zeros_like(importances)
 
     for r in tqdm(results, 'Merging results'):
         tyear_idx = np.searchsorted(years, r['train_year'])
@@ -116,6 +174,8 @@ def main(trainingfile, resultfile):
 
         fold_idx = np.searchsorted(folds, r['fold'])
         importances[tyear_idx, fold_idx, :] = np.array([r['importances'][n] for n in feature_names])
+        if n_repeats > 0:
+            permuted[tyear_idx, fold_idx, :] = np.array([r['permutation_importances'][n] for n in feature_names])
 
     out = {
         'ids': ids,
@@ -126,6 +186,8 @@ def main(trainingfile, resultfile):
         'feature_names': np.asarray(feature_names),
         'folds': np.asarray(folds),
     }
+    if n_repeats > 0:
+        out['permutation_importances'] = permuted
 
     np.savez_compressed(resultfile, **out)
 
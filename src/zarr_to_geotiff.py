@@ -1,14 +1,90 @@
 #!/usr/bin/env python
 import json
 import click
+import dask
 import xarray as xr
+import rioxarray
 from tqdm import tqdm
 from pathlib import Path
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from werkzeug.security import safe_join
 
+from profiling import profile_option
+
+
+# GeoTIFF predictor values mapped to COG driver option names
+COG_PREDICTORS = {
+    1: 'NO',
+    2: 'STANDARD',
+    3: 'FLOATING_POINT',
+}
+
+
+def get_raster_options(config):
+    """
+    Build the rasterio driver/creation options for the configured layout:
+      - "striped": plain GeoTIFF (the original output format)
+      - "tiled": internally tiled GeoTIFF
+      - "cog": Cloud-Optimized GeoTIFF with internal tiling and overviews
+    """
+    layout = config.get('layout', 'striped')
+    compress = config.get('compress', 'LZMA')
+    level = config.get('level', None)
+    predictor = config.get('predictor', None)
+    blocksize = config.get('blocksize', 512)
+
+    if layout == 'cog':
+        options = {
+            'driver': 'COG',
+            'compress': compress,
+            'blocksize': blocksize,
+            'overviews': config.get('overviews', 'AUTO'),
+            'overview_resampling': config.get(
+                'overview_resampling', 'AVERAGE'
+            ),
+        }
+        if level is not None:
+            options['level'] = level
+        if predictor is not None:
+            options['predictor'] = COG_PREDICTORS.get(predictor, predictor)
+        return options
+
+    options = {'driver': 'GTiff', 'compress': compress}
+    if layout == 'tiled':
+        options.update(
+            tiled=True, blockxsize=blocksize, blockysize=blocksize
+        )
+    elif layout != 'striped':
+        raise ValueError(f'Unknown GeoTIFF layout "{layout}"')
+
+    if level is not None:
+        if compress.upper() == 'DEFLATE':
+            options['zlevel'] = level
+        elif compress.upper() == 'ZSTD':
+            options['zstd_level'] = level
+    if predictor is not None:
+        options['predictor'] = predictor
+
+    return options
+
+
+def export_raster(zarrfile, var, year, opath, options):
+    # Each worker reads its own slice; keep dask single-threaded so the
+    # process pool is the only source of parallelism
+    with dask.config.set(scheduler='synchronous'):
+        with xr.open_zarr(zarrfile) as ds:
+            dat = ds[var].sel(year=year).load()
+
+    dat = dat.rename(northing='y', easting='x')
+    dat = dat.assign_attrs(year=year, short_name=var)
+    dat.rio.to_raster(opath, **options)
+
+    return opath
+
 
 @click.command()
+@profile_option
 @click.argument('zarrfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -18,7 +94,8 @@ from werkzeug.security import safe_join
 @click.option('-c', '--configfile', default=None,
     type=click.Path(path_type=Path, exists=True)
 )
-def main(zarrfile, outputdir, configfile):
+@click.option('-j', '--workers', default=None, type=int)
+def main(zarrfile, outputdir, configfile, workers):
 
     if configfile is not None:
         with open(configfile, 'r') as f:
@@ -27,24 +104,38 @@ def main(zarrfile, outputdir, configfile):
         config = {}
 
     file_fmt = config.get('filename_format', '{variable}_{year}.tif')
+    options = get_raster_options(config)
+    if workers is None:
+        workers = config.get('workers', 1)
 
     ds = xr.open_zarr(zarrfile)
 
-    tasks = []
-
     pairs = list(product(ds.data_vars, ds.year.values))
 
-    for var, year in tqdm(pairs, 'Converting'):
-        ofile = file_fmt.format(variable=var, year=year)
-        opath = safe_join(outputdir, ofile)
+    if workers <= 1:
+        for var, year in tqdm(pairs, 'Converting'):
+            ofile = file_fmt.format(variable=var, year=year)
+            opath = safe_join(outputdir, ofile)
 
-        da = ds[var]
-        dat = da.sel(year=year)
-        dat = dat.rename(northing='y', easting='x')
-        dat = dat.assign_attrs(year=year, short_name=var)
-        dat.rio.to_raster(
-            opath, compute=True, compress='LZMA'
-        )
+            da = ds[var]
+            dat = da.sel(year=year)
+            dat = dat.rename(northing='y', easting='x')
+            dat = dat.assign_attrs(year=year, short_name=var)
+            dat.rio.to_raster(opath, compute=True, **options)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                export_raster, zarrfile, var, int(year),
+                safe_join(outputdir, file_fmt.format(variable=var, year=year)),
+                options
+            )
+            for var, year in pairs
+        ]
+        for future in tqdm(as_completed(futures), 'Converting',
+                total=len(futures)):
+            future.result()
 
 
 if __name__ == '__main__':
@@ -1,12 +1,81 @@
 #!/usr/bin/env python
+import os
+import time
 import click
+import dask
 import json
 from pathlib import Path
-import xarray as xr
-from dask.diagnostics import ProgressBar
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from append_folds import open_folds
+from execution import start_execution, run
+from profiling import profile_option
+
+
+# Encoding entries carried over from the Zarr store
+KEEP_ENCODING = ('dtype', '_FillValue', 'scale_factor', 'add_offset')
+
+
+def get_encoding(ds, complevel=9, shuffle=False):
+    """
+    Build NetCDF encodings with HDF5 chunk shapes matching the (Zarr or
+    configured) dask chunks so each chunk is compressed exactly once
+    """
+    encoding = {}
+    for v in ds.data_vars:
+        var = ds[v]
+        enc = {
+            k: val for k, val in var.encoding.items()
+            if k in KEEP_ENCODING
+        }
+        enc.update(zlib=True, complevel=complevel, shuffle=shuffle)
+        if var.chunks is not None and var.ndim > 0:
+            enc['chunksizes'] = var.data.chunksize
+        encoding[v] = enc
+    return encoding
+
+
+def variable_file(nc4file, var):
+    return nc4file.with_name(f'{nc4file.stem}_{var}{nc4file.suffix}')
+
+
+def write_index(ds, nc4file):
+    """
+    Write the coordinates and attributes of a split dataset, with the
+    names of its variable files, to the requested output file
+    """
+    index = ds.drop_vars(list(ds.data_vars))
+    index.attrs['variable_files'] = ' '.join(
+        variable_file(nc4file, v).name for v in ds.data_vars
+    )
+    index.to_netcdf(nc4file, engine='h5netcdf')
+
+
+def write_variable(zarrfile, var, ofile, chunk_config, complevel, shuffle):
+    # The process pool provides the parallelism; each writer runs serially
+    with dask.config.set(scheduler='synchronous'):
+        with open_folds(zarrfile) as ds:
+            ds = ds[[var]]
+            if chunk_config is not None:
+                ds = ds.chunk(chunk_config)
+            ds.to_netcdf(
+                ofile, engine='h5netcdf',
+                encoding=get_encoding(ds, complevel, shuffle)
+            )
+    return os.path.getsize(ofile)
+
+
+def report_throughput(nbytes, written, elapsed):
+    print(
+        f'Wrote {written / 2**20:.1f} MiB '
+        f'({nbytes / 2**20:.1f} MiB uncompressed) in {elapsed:.1f} s: '
+        f'{nbytes / 2**20 / max(elapsed, 1e-9):.1f} MiB/s'
+    )
 
 
 @click.command()
+@profile_option
 @click.argument('zarrfile', type=click.Path(
     path_type=Path, exists=True
 ))
@@ -25,24 +94,51 @@ def main(zarrfile, nc4file, configfile):
         config = {}
 
     chunk_config = config.get('chunks', None)
+    complevel = config.get('complevel', 9)
+    shuffle = config.get('shuffle', False)
+    split = config.get('split_variables', False)
+    workers = config.get('workers', None)
+
+    start_execution(config)
 
-    ds = xr.open_zarr(zarrfile)
+    ds = open_folds(zarrfile)
 
     if chunk_config is not None:
         ds = ds.chunk(chunk_config)
 
-    # Add compression to encoding
-    comp = dict(zlib=True, complevel=9)
-    for v in ds.data_vars:
-        ds[v].encoding.update(comp)
+    start = time.perf_counter()
 
-    write_job = ds.to_netcdf(
-        nc4file, engine='h5netcdf',
-        compute=False
-    )
+    if split:
+        # Write one file per variable, in parallel, and an index file at
+        # the requested output
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    write_variable, zarrfile, v, variable_file(nc4file, v),
+                    chunk_config, complevel, shuffle
+                )
+                for v in ds.data_vars
+            ]
+            written = sum(
+                f.result() for f in tqdm(
+                    as_completed(futures), 'Writing Variables',
+                    total=len(futures)
+                )
+            )
+        write_index(ds, nc4file)
+
+    else:
+        write_job = ds.to_netcdf(
+            nc4file, engine='h5netcdf',
+            encoding=get_encoding(ds, complevel, shuffle),
+            compute=False
+        )
+
+        run(write_job)
+
+        written = os.path.getsize(nc4file)
 
-    with ProgressBar():
-        write_job.persist()
+    report_throughput(ds.nbytes, written, time.perf_counter() - start)
 
 
 if __name__ == '__main__':
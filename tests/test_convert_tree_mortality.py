@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+import xarray as xr
+import geopandas as gpd
+import rioxarray  # noqa: F401
+import shapely.geometry
+from tqdm import tqdm
+
+from convert_tree_mortality import apply_masks
+
+
+CRS = 'EPSG:3310'
+
+
+def mortality_dataset():
+    rng = np.random.default_rng(0)
+    years = np.arange(2000, 2004)
+    values = rng.random((len(years), 20, 30))
+    values[values < 0.1] = np.nan
+    ds = xr.Dataset(
+        { 'tpa': (('year', 'northing', 'easting'), values) },
+        coords={
+            'year': years,
+            'northing': 1000.0 - 10.0 * np.arange(20) - 5,
+            'easting': 10.0 * np.arange(30) + 5,
+        },
+    )
+    return ds.rio.write_crs(CRS)
+
+
+def regions(xmin, ymin, xmax, ymax):
+    return gpd.GeoDataFrame(
+        geometry=[shapely.geometry.box(xmin, ymin, xmax, ymax)], crs=CRS
+    )
+
+
+def clip_masks(dataset, region_df_dict, default_region_df, years):
+    """
+    The masking done with rio.clip per year before masks were rasterized
+    once
+    """
+    dataset = dataset.fillna(0.0)
+    dataset = dataset.rename({ 'easting': 'x', 'northing': 'y' })
+
+    if len(region_df_dict) == 0:
+        dataset = dataset.rio.clip(
+            default_region_df.geometry.values, default_region_df.crs
+        )
+
+    else:
+        dataset = xr.concat([
+            dataset.sel(year=y).rio.clip(
+                region_df_dict.get(y, default_region_df).geometry.values,
+                region_df_dict.get(y, default_region_df).crs
+            )
+            for y in tqdm(years, 'Applying Masks')
+            ],
+            dim='year',
+            data_vars='all',
+            coords='different',
+        )
+
+    return dataset.rename({ 'x': 'easting', 'y': 'northing' })
+
+
+@pytest.mark.parametrize('annual', [False, True])
+@pytest.mark.parametrize('chunks', [None, { 'year': 1, 'northing': 8 }])
+def test_apply_masks_matches_clip(annual, chunks):
+    ds = mortality_dataset()
+    years = ds.year.values
+    default = regions(42, 823, 218, 951)
+    if annual:
+        region_df_dict = {
+            2001: regions(60, 850, 230, 990),
+            2003: regions(60, 850, 230, 990),
+        }
+    else:
+        region_df_dict = {}
+
+    expected = clip_masks(ds, region_df_dict, default, years)
+    actual = apply_masks(
+        ds, region_df_dict, default, years, chunks=chunks
+    ).compute()
+
+    if annual:
+        # rio.clip per year and concat keeps the transform of the first
+        # year; the union of the yearly extents has its own
+        transform = actual.rename({ 'easting': 'x', 'northing': 'y' }).rio
+        assert actual.spatial_ref.attrs['GeoTransform'] == ' '.join(
+            map(str, transform.transform(recalc=True).to_gdal())
+        )
+        for ds in (actual, expected):
+            del ds.spatial_ref.attrs['GeoTransform']
+
+    # Values, coordinates, and the attributes rio.clip writes
+    xr.testing.assert_identical(actual, expected)
+    for name in ('easting', 'northing', 'spatial_ref'):
+        assert actual[name].attrs == expected[name].attrs
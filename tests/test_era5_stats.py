@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from era5_stats import daily_block, get_annual_stats
+
+
+STATS = [
+    { 'variable': 't2m', 'name': 't2m_max', 'function': 'max' },
+    { 'variable': 't2m', 'name': 't2m_mean', 'function': 'mean' },
+    { 'variable': 't2m', 'name': 't2m_count', 'function': 'count' },
+    { 'variable': 't2m', 'name': 't2m_median', 'function': 'median' },
+    { 'variable': 't2m', 'name': 't2m_q90', 'function': 'quantile',
+      'kwargs': { 'q': 0.9 } },
+    { 'variable': 't2m', 'name': 't2m_std', 'function': 'std',
+      'kwargs': { 'ddof': 1 } },
+    { 'variable': 't2m', 'name': 't2m_sum', 'function': 'sum',
+      'kwargs': { 'skipna': False } },
+]
+
+
+def leap_year_series():
+    time = pd.date_range('2020-01-01', '2020-12-31T23:00', freq='h')
+    rng = np.random.default_rng(0)
+    values = rng.normal(280.0, 5.0, (len(time), 3))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    values[24 * 10:24 * 11, 0] = np.nan
+    return xr.Dataset(
+        { 't2m': (('time', 'x'), values) },
+        coords={ 'time': time, 'x': [0, 1, 2] },
+    )
+
+
+def groupby_stats(ds, stats):
+    """
+    Daily statistics as computed with groupby before the daily kernel
+    """
+    groups = ds.groupby('time.dayofyear')
+    stat_vars = [
+        getattr(groups, sd['function'])(**sd.get('kwargs', {}))[sd['variable']]
+        .rename(sd['name'])
+        for sd in stats
+    ]
+    out = xr.merge(stat_vars)
+    out = out.drop_sel(dayofyear=60)
+    return out.assign_coords(dayofyear=np.arange(1, 366, dtype=int))
+
+
+def test_matches_groupby_on_leap_year():
+    ds = leap_year_series()
+    expected = groupby_stats(ds, STATS)
+    actual = get_annual_stats(ds.chunk({ 'x': 2 }), [2020], STATS)
+    for sd in STATS:
+        np.testing.assert_allclose(
+            actual[sd['name']].isel(year=0).values,
+            expected[sd['name']].values,
+            rtol=1e-12, equal_nan=True, err_msg=sd['name'],
+        )
+
+
+def test_rejects_unsupported_statistic():
+    with pytest.raises(ValueError, match='Unsupported statistic'):
+        daily_block(np.zeros((24, 2)), [('argmax', {})])
@@ -0,0 +1,80 @@
+import os
+import threading
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip('cdsapi')
+
+import fetch_era5
+
+
+class LocalClient(object):
+    """
+    Stand-in for cdsapi.Client that writes a small NetCDF file per request
+    """
+
+    def __init__(self, requests):
+        self.requests = requests
+
+    def retrieve(self, dataset, request, target):
+        self.requests.append((dataset, request['year']))
+        ds = xr.Dataset(
+            { 't2m': (('time',), np.full(3, float(request['year']))) },
+            coords={ 'time': np.arange(3) },
+        )
+        ds.to_netcdf(target)
+
+
+def fake_factory():
+    requests = []
+    lock = threading.Lock()
+
+    def factory():
+        with lock:
+            return LocalClient(requests)
+    return factory, requests
+
+
+def year_paths(outdir, years):
+    return [(y, os.path.join(outdir, f'{y}.nc')) for y in years]
+
+
+def test_download_all_records_manifest(tmp_path):
+    factory, requests = fake_factory()
+    manifest_path = str(tmp_path / fetch_era5.MANIFEST_NAME)
+    paths = year_paths(str(tmp_path), range(2000, 2005))
+
+    fetch_era5.download_all(
+        factory, 'era5', {}, paths, manifest_path, workers=3
+    )
+
+    assert sorted(y for _, y in requests) == list(range(2000, 2005))
+    manifest = fetch_era5.load_manifest(manifest_path)
+    for _, p in paths:
+        assert fetch_era5.is_complete(manifest, p, verify=True)
+    assert not any(f.endswith('.part') for f in os.listdir(tmp_path))
+
+
+def test_existing_files_are_not_fetched_again(tmp_path):
+    factory, requests = fake_factory()
+    manifest_path = str(tmp_path / fetch_era5.MANIFEST_NAME)
+    paths = year_paths(str(tmp_path), range(2000, 2004))
+
+    # Files downloaded before there was a manifest, one of them truncated
+    LocalClient([]).retrieve('era5', { 'year': 2000 }, paths[0][1])
+    LocalClient([]).retrieve('era5', { 'year': 2001 }, paths[1][1])
+    with open(paths[2][1], 'wb') as f:
+        f.write(b'CDF\x01')
+
+    manifest = fetch_era5.load_manifest(manifest_path)
+    assert fetch_era5.seed_manifest(manifest, paths)
+    fetch_era5.save_manifest(manifest, manifest_path)
+    missing = [
+        (y, p) for y, p in paths if not fetch_era5.is_complete(manifest, p)
+    ]
+    fetch_era5.download_all(factory, 'era5', {}, missing, manifest_path)
+
+    assert sorted(y for _, y in requests) == [2002, 2003]
+    manifest = fetch_era5.load_manifest(manifest_path)
+    assert all(fetch_era5.is_complete(manifest, p) for _, p in paths)
@@ -0,0 +1,43 @@
+import numpy as np
+import xarray as xr
+import dask
+
+from precision import apply_precision
+
+
+def write_and_read(ds, path):
+    ds.to_zarr(path, mode='w', consolidated=True)
+    return xr.open_zarr(path).load()
+
+
+def report(ds, spec):
+    cast, deviations = apply_precision(ds, spec)
+    (values,) = dask.compute({ k: v.data for k, v in deviations.items() })
+    return cast, { k: float(v) for k, v in values.items() }
+
+
+def test_int16_deviation_matches_stored_values(tmp_path):
+    ds = xr.Dataset({
+        'v': ('x', np.array([1.0, 500.0, -400.0, np.nan, 0.123456])),
+    })
+    spec = { 'dtype': 'int16', 'scale_factor': 0.01 }
+    cast, deviations = report(ds, spec)
+    stored = write_and_read(cast, tmp_path / 'packed.zarr')
+
+    # Out of range values are clipped to the packed range, not wrapped
+    np.testing.assert_allclose(
+        stored['v'].values, [1.0, 327.67, -327.67, np.nan, 0.12],
+        atol=1e-5,
+    )
+    actual = float(np.nanmax(abs(stored['v'].values - ds['v'].values)))
+    assert np.isclose(deviations['v'], actual)
+
+
+def test_float32_deviation_matches_stored_values(tmp_path):
+    ds = xr.Dataset({ 'v': ('x', np.array([0.1, 1e10 + 1.0, -3.3])) })
+    cast, deviations = report(ds, 'float32')
+    stored = write_and_read(cast, tmp_path / 'float.zarr')
+
+    assert stored['v'].dtype == np.float32
+    actual = float(abs(stored['v'].values.astype(float) - ds['v'].values).max())
+    assert deviations['v'] == actual
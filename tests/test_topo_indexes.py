@@ -0,0 +1,85 @@
+import numpy as np
+
+from topo_indexes import compute_metrics, gradient, sdmv, slope_aspect
+
+
+def synthetic_dem(rows=40, cols=50):
+    y, x = np.mgrid[0:rows, 0:cols]
+    z = 100 + 3 * x + 2 * y + 10 * np.sin(x / 5.0) * np.cos(y / 7.0)
+    z[15:18, 20:23] = np.nan
+    return z
+
+
+def coast_dem(rows=60, cols=60):
+    y, x = np.mgrid[0:rows, 0:cols]
+    z = 5 + 3 * x + 2 * y + 10 * np.sin(x / 5.0) * np.cos(y / 7.0)
+    z[(x - 10)**2 + (y - 30)**2 < 20**2] = np.nan
+    return z
+
+
+def test_gradient_skips_missing_neighbors():
+    z = coast_dem()
+    slope, eastness, northness = slope_aspect(z, 4, 30.0, 30.0)
+    land = np.isfinite(z)
+    dzdx, dzdy = gradient(z, 4, 30.0, 30.0)
+    complete = np.isfinite(dzdx)
+    assert (land & ~complete).sum() > 0.3 * land.sum()
+
+    # Only cells whose valid neighbors lie on a line have no gradient
+    for values in (slope, eastness, northness):
+        assert np.isnan(values[land]).sum() < 0.01 * land.sum()
+        assert np.isnan(values[~land]).all()
+
+    # Cells with all neighbors keep the Horn gradient
+    horn = np.degrees(np.arctan(np.hypot(dzdx, dzdy)))
+    assert np.allclose(slope[complete], horn[complete])
+
+
+def test_gradient_of_plane_with_nodata():
+    y, x = np.mgrid[0:30, 0:30]
+    z = 0.5 * x - 0.2 * y
+    z[np.random.default_rng(0).random(z.shape) < 0.3] = np.nan
+    slope, eastness, northness = slope_aspect(z, 2, 1.0, 1.0)
+    defined = np.isfinite(slope)
+    assert defined.sum() > 0.9 * np.isfinite(z).sum()
+    g = np.hypot(0.5, 0.2)
+    assert np.allclose(slope[defined], np.degrees(np.arctan(g)))
+    assert np.allclose(eastness[defined], -0.5 / g)
+    assert np.allclose(northness[defined], -0.2 / g)
+
+
+def test_aspect_is_nan_without_gradient():
+    # A lone land cell has no neighbors to fit a plane to
+    z = np.full((9, 9), np.nan)
+    z[4, 4] = 10.0
+    slope, eastness, northness = slope_aspect(z, 1, 30.0, 30.0)
+    assert np.isnan(slope[4, 4])
+    assert np.isnan(eastness[4, 4]) and np.isnan(northness[4, 4])
+
+
+def test_flat_cells_have_zero_aspect():
+    z = np.full((20, 20), 50.0)
+    slope, eastness, northness = slope_aspect(z, 1, 30.0, 30.0)
+    inner = np.isfinite(slope)
+    assert (slope[inner] == 0).all()
+    assert (eastness[inner] == 0).all() and (northness[inner] == 0).all()
+
+
+def test_sdmv_circle_radius():
+    # A single raised cell is within the circle of radius 3 at distance 3
+    # along an axis, but not at (2, 3)
+    z = np.zeros((15, 15))
+    z[7, 7] = 1.0
+    values = sdmv(z, 3)
+    n = 29  # cells within distance 3 of the center
+    assert np.isclose(values[7, 4], (0 - 1.0 / n) / 1.0)
+    assert np.isnan(values[5, 4])
+
+
+def test_metrics_keep_nodata():
+    z = synthetic_dem()
+    results = compute_metrics(
+        z, 9, 30.0, 30.0, ['slope', 'eastness', 'sdmv']
+    )
+    for values in results.values():
+        assert np.isnan(values[np.isnan(z)]).all()
@@ -34,17 +34,17 @@ handle_error() {
 #    echo "Topographic features generation completed successfully."
 #}
 
-# Step 9: Merge Topographic Features with Annual Dataset
+# Step 9: Compute Topographic Features on the Annual Dataset Grid
 topo() {
     echo "Starting topo function..."
 
-    local features="${topodir}/generated"
+    local demfile="${topodir}/${config_topobase}"
     local bcm="${bcmdir}/BCMv8_annual.zarr"
     local output_directory="${topodir}/topo_indexes.zarr"
-    local config="${config_topo_config}"
+    local config="${config_topo_index_config}"
 
-    if [ ! -d "$features" ]; then
-        handle_error "Features directory $features does not exist."
+    if [ ! -f "$demfile" ]; then
+        handle_error "DEM file $demfile does not exist."
     fi
     if [ ! -d "$bcm" ]; then
         handle_error "BCM directory $bcm does not exist."
@@ -55,11 +55,11 @@ topo() {
 
     delete_directory "${output_directory}"
 
-    # Execute the merge_topo_features.py script
-    echo "Executing python script to merge topographic features..."
-    python src/merge_topo_features.py "$features"/*.nc "$bcm" "$config" "$output_directory" || handle_error "Merging topographic features failed."
+    # Execute the topo_indexes.py script
+    echo "Executing python script to compute topographic features..."
+    python src/topo_indexes.py "$demfile" "$bcm" "$config" "$output_directory" || handle_error "Computing topographic features failed."
 
-    echo "Merging topographic features completed successfully."
+    echo "Computing topographic features completed successfully."
 }
 
 # Execute the steps
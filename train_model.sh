@@ -31,7 +31,7 @@ train_model() {
 
     # Execute the train_rf_model_ray.py script
     echo "Executing python script to train model..."
-    python src/train_rf_model_ray.py "$input_file" "$output_file" || handle_error "Training model failed."
+    cached "$output_file" python src/train_rf_model_ray.py "$input_file" "$output_file" || handle_error "Training model failed."
 
     echo "Training model completed successfully for $base."
 }